@@ -1,5 +1,5 @@
 import sys, os, errno, stat
-import vars, jwack, state
+import vars, jwack, state, cache
 from helpers import unlink, close_on_exec, join
 from log import log, log_, debug, debug2, err, warn
 
@@ -35,16 +35,65 @@ def _possible_do_files(t):
                    subdir, os.path.join(subdir, basename), ext)
         
 
+# Looking for a .do file can mean trying a dozen or more candidates in each
+# of the target's directory and its parents, and every target in the same
+# directory tries the same ones.  So instead of stat()ing every candidate,
+# we check them against state.dofiles(), which lists each directory once.
+def _do_exists(d, name):
+    return (name in state.dofiles(d) and
+            state.exists(os.path.join(d, name)))
+
+
+# Targets in the same directory with the same extensions (say, all the *.o
+# in src/) end up with the same rule, unless one has its own .do file.  So
+# remember which candidate won, by its position in the search.
+_rules = {}     # (directory, extensions) -> index of winning candidate
+_searched = {}  # names of the state.dofiles_name() files we've updated
 def _find_do_file(f):
+    dirname,filename = os.path.split(os.path.join(vars.BASE, f.name))
+    key = (dirname, tuple(filename.split('.')[1:]))
+    if _do_exists(dirname, '%s.do' % filename):
+        win = 0
+    else:
+        win = _rules.get(key)
+    dirs = []
+    i = 0
+    result = None,None,None,None,None
     for dodir,dofile,basedir,basename,ext in _possible_do_files(f.name):
         dopath = os.path.join(dodir, dofile)
         debug2('%s: %s:%s ?\n' % (f.name, dodir, dofile))
-        if os.path.exists(dopath):
-            f.add_dep('m', dopath)
-            return dodir,dofile,basedir,basename,ext
+        d = os.path.normpath(dodir)
+        if not dirs or dirs[-1] != d:
+            dirs.append(d)
+        if win == None:
+            found = _do_exists(dodir, dofile)
+        elif i == win:
+            found = state.exists(dopath)
+            if not found:
+                win = None  # it's gone; look properly after all
         else:
-            f.add_dep('c', dopath)
-    return None,None,None,None,None
+            found = False
+        if found:
+            if i:
+                _rules[key] = i
+            f.add_dep('m', dopath)
+            result = dodir,dofile,basedir,basename,ext
+            break
+        i += 1
+    else:
+        if win == None:
+            _rules[key] = -1
+    # instead of remembering each candidate that wasn't there, depend on
+    # the list of .do files in each directory we looked in.
+    names = [state.dofiles_name(d) for d in dirs]
+    for name in names:
+        if name not in _searched:
+            sf = state.File(name=name)
+            sf.set_static()
+            sf.save()
+            _searched[name] = 1
+    f.add_deps('m', names)
+    return result
 
 
 def _nice(t):
@@ -68,7 +117,7 @@ class ImmediateReturn(Exception):
 
 
 class BuildJob:
-    def __init__(self, t, sf, lock, shouldbuildfunc, donefunc):
+    def __init__(self, t, sf, lock, shouldbuildfunc, donefunc, token_wait=0):
         self.t = t  # original target name, not relative to vars.BASE
         self.sf = sf
         tmpbase = t
@@ -82,17 +131,37 @@ class BuildJob:
         self.shouldbuildfunc = shouldbuildfunc
         self.donefunc = donefunc
         self.before_t = _try_stat(self.t)
+        self.job = None
+        self.cachekey = None
+        self.token_wait = token_wait  # seconds main() waited for our token
+        # where the processes of our .do script leave their changes to t
+        self.journal = '%s/.redo/journal.%d.%d' % (vars.BASE, os.getpid(),
+                                                   id(self))
 
     def start(self):
+        dirty = self.check()
+        if dirty:
+            self.build(dirty)
+
+    def check(self):
+        """Find out whether t needs to be built, without building it.
+
+        Returns a true value (for build()) if so.  Otherwise, we're done
+        with t already.  This doesn't need a jobserver token.
+        """
         assert(self.lock.owned)
         try:
             dirty = self.shouldbuildfunc(self.t)
             if not dirty:
                 # target doesn't need to be built; skip the whole task
-                return self._after2(0)
+                self._after2(0)
+            return dirty
         except ImmediateReturn, e:
-            return self._after2(e.rv)
+            self._after2(e.rv)
+            return None
 
+    def build(self, dirty):
+        assert(self.lock.owned)
         if vars.NO_OOB or dirty == True:
             self._start_do()
         else:
@@ -130,16 +199,15 @@ class BuildJob:
         if not dofile:
             if os.path.exists(t):
                 sf.set_static()
+                # its only dependencies now are the places we looked for a
+                # .do file, and we just looked.
+                sf.zap_deps2()
+                sf.set_checked()
                 sf.save()
                 return self._after2(0)
             else:
                 err('no rule to make %r\n' % t)
                 return self._after2(1)
-        unlink(self.tmpname1)
-        unlink(self.tmpname2)
-        ffd = os.open(self.tmpname1, os.O_CREAT|os.O_RDWR|os.O_EXCL, 0666)
-        close_on_exec(ffd, True)
-        self.f = os.fdopen(ffd, 'w+')
         # this will run in the dofile's directory, so use only basenames here
         if vars.OLD_ARGS:
             arg1 = basename  # target name (no extension)
@@ -170,8 +238,110 @@ class BuildJob:
         dof = state.File(name=os.path.join(dodir, dofile))
         dof.set_static()
         dof.save()
-        state.commit()
-        jwack.start_job(t, self._do_subproc, self._after)
+        state.commit(before_job=True)
+        if cache.enabled():
+            self.cachekey = cache.manifest_key(sf, os.path.join(dodir, dofile),
+                                               [arg1, arg2])
+            try:
+                deps = cache.manifest(self.cachekey)
+            except (OSError, IOError), e:
+                warn('%s: cache: %s\n' % (_nice(t), e))
+                deps = None
+            if deps != None:
+                return self._start_probe(deps)
+        self._do_subproc()
+
+    def _env(self):
+        # careful: REDO_PWD was the PWD relative to the STARTPATH at the time
+        # we *started* building the current target; but that target ran
+        # redo-ifchange, and it might have done it from a different directory
+        # than we started it in.  So os.getcwd() might be != REDO_PWD right
+        # now.
+        env = dict(os.environ)
+        env['REDO_PWD'] = state.relpath(os.path.realpath(self.dodir),
+                                        vars.STARTDIR)
+        env['REDO_TARGET'] = self.basename + self.ext
+        env['REDO_DEPTH'] = vars.DEPTH + '  '
+        # a redo that died before applying its journal might have had our
+        # pid, and its leftovers mustn't look like ours.
+        unlink(self.journal)
+        env['REDO_JOURNAL'] = self.journal
+        return env
+
+    def _start_probe(self, deps):
+        # The cache might have a result for us, but we can't tell which one
+        # until everything the .do script depended on last time is up to
+        # date.  So do what it would have done first: redo-ifchange all of
+        # them, on behalf of our target.
+        self.cachedeps = deps
+        argv = ['redo-ifchange']
+        for mode,name in deps:
+            if mode == 'm':
+                path = os.path.join(vars.BASE, name)
+                f = state.File(name=path)
+                if not f.is_generated and not state.exists(path):
+                    # a source file that went away; this can't match, and
+                    # redo-ifchange would just complain about it.
+                    return self._after_probe(self.t, 1)
+                argv.append(path)
+        if len(argv) == 1:
+            return self._after_probe(self.t, 0)
+        self.job = jwack.spawn_job(self.t, argv, self._env(), self.dodir,
+                                   None, self._after_probe)
+
+    def _after_probe(self, t, rv):
+        state.forget_stat()
+        state.apply_journal(self.journal)
+        try:
+            ok = rv == 0 and state.check_sane() and self._restore()
+        except (OSError, IOError), e:
+            warn('%s: cache: %s\n' % (_nice(t), e))
+            ok = False
+        if ok:
+            state.commit()
+            return self._after2(0)
+        # no such luck.  Forget the dependencies we just declared, in case
+        # the .do script doesn't want them anymore, and run it for real.
+        debug('%s: not in cache\n' % _nice(t))
+        self.sf.zap_deps1()
+        _find_do_file(self.sf)
+        state.commit(before_job=True)
+        self._do_subproc()
+
+    def _restore(self):
+        t = self.t
+        unlink(self.tmpname2)
+        if not cache.restore(self.cachekey, self.cachedeps, self.tmpname2):
+            return False
+        debug('%s: restored from cache\n' % _nice(t))
+        if os.path.exists(self.tmpname2):
+            os.rename(self.tmpname2, t)
+        else:
+            unlink(t)
+        sf = self.sf
+        self._built(sf)
+        # the probe only redid the redo-ifchange ones for us.
+        cdeps = [os.path.join(vars.BASE, name)
+                 for mode,name in self.cachedeps if mode == 'c']
+        if cdeps:
+            sf.add_deps('c', cdeps)
+        sf.zap_deps2()
+        sf.save()
+        return True
+
+    def _built(self, sf):
+        state.forget_stat(os.path.join(vars.BASE, sf.name))
+        sf.refresh()
+        sf.is_generated = True
+        sf.is_override = False
+        if sf.is_checked() or sf.is_changed():
+            # it got checked during the run; someone ran redo-stamp.
+            # update_stamp would call set_changed(); we don't want that
+            sf.stamp = sf.read_stamp()
+        else:
+            sf.csum = None
+            sf.update_stamp()
+            sf.set_changed()
 
     def _start_unlocked(self, dirty):
         # out-of-band redo of some sub-objects.  This happens when we're not
@@ -186,41 +356,31 @@ class BuildJob:
         # grab a lock.
         argv = ['redo-unlocked', self.sf.name] + [d.name for d in dirty]
         log('(%s)\n' % _nice(self.t))
-        state.commit()
-        def run():
-            os.chdir(vars.BASE)
-            os.environ['REDO_DEPTH'] = vars.DEPTH + '  '
-            os.execvp(argv[0], argv)
-            assert(0)
-            # returns only if there's an exception
+        state.commit(before_job=True)
+        env = dict(os.environ)
+        env['REDO_DEPTH'] = vars.DEPTH + '  '
         def after(t, rv):
+            state.forget_stat()
             return self._after2(rv)
-        jwack.start_job(self.t, run, after)
+        jwack.spawn_job(self.t, argv, env, vars.BASE, None, after)
 
     def _do_subproc(self):
-        # careful: REDO_PWD was the PWD relative to the STARTPATH at the time
-        # we *started* building the current target; but that target ran
-        # redo-ifchange, and it might have done it from a different directory
-        # than we started it in.  So os.getcwd() might be != REDO_PWD right
-        # now.
-        dn = self.dodir
-        newp = os.path.realpath(dn)
-        os.environ['REDO_PWD'] = state.relpath(newp, vars.STARTDIR)
-        os.environ['REDO_TARGET'] = self.basename + self.ext
-        os.environ['REDO_DEPTH'] = vars.DEPTH + '  '
-        if dn:
-            os.chdir(dn)
-        os.dup2(self.f.fileno(), 1)
-        os.close(self.f.fileno())
-        close_on_exec(1, False)
+        unlink(self.tmpname1)
+        unlink(self.tmpname2)
+        ffd = os.open(self.tmpname1, os.O_CREAT|os.O_RDWR|os.O_EXCL, 0666)
+        close_on_exec(ffd, True)
+        self.f = os.fdopen(ffd, 'w+')
         if vars.VERBOSE or vars.XTRACE: log_('* %s\n' % ' '.join(self.argv))
-        os.execvp(self.argv[0], self.argv)
-        assert(0)
-        # returns only if there's an exception
+        self.job = jwack.spawn_job(self.t, self.argv, self._env(), self.dodir,
+                                   self.f.fileno(), self._after)
 
     def _after(self, t, rv):
         try:
+            # the job (or any sub-redo it ran) might have rebuilt files we
+            # already stat()ed, so we can't trust any of our cached stats.
+            state.forget_stat()
             state.check_sane()
+            state.apply_journal(self.journal)
             rv = self._after1(t, rv)
             state.commit()
         finally:
@@ -242,6 +402,7 @@ class BuildJob:
             err('%s wrote to stdout *and* created $3.\n' % self.argv[2])
             err('...you should write status messages to stderr, not stdout.\n')
             rv = 207
+        cacheable = False
         if rv==0:
             if st2:
                 os.rename(self.tmpname2, t)
@@ -260,23 +421,27 @@ class BuildJob:
                 unlink(self.tmpname1)
                 unlink(t)
             sf = self.sf
-            sf.refresh()
-            sf.is_generated = True
-            sf.is_override = False
-            if sf.is_checked() or sf.is_changed():
-                # it got checked during the run; someone ran redo-stamp.
-                # update_stamp would call set_changed(); we don't want that
-                sf.stamp = sf.read_stamp()
-            else:
-                sf.csum = None
-                sf.update_stamp()
-                sf.set_changed()
+            self._built(sf)
+            # a checksum means the .do script used redo-stamp, which has
+            # to run for real every time.
+            cacheable = not sf.csum
         else:
             unlink(self.tmpname1)
             unlink(self.tmpname2)
             sf = self.sf
             sf.set_failed()
+        job = self.job
+        if job.end:
+            ru = job.rusage
+            state.add_history(sf.id, job.start, job.end - job.start,
+                              ru and ru.ru_utime, ru and ru.ru_stime,
+                              ru and ru.ru_maxrss, self.token_wait)
         sf.zap_deps2()
+        if rv == 0 and cacheable and self.cachekey:
+            try:
+                cache.add(self.cachekey, sf, t)
+            except (OSError, IOError), e:
+                warn('%s: cache: %s\n' % (_nice(t), e))
         sf.save()
         f.close()
         if rv != 0:
@@ -294,11 +459,34 @@ class BuildJob:
             self.lock.unlock()
 
 
-def main(targets, shouldbuildfunc):
+def _longest_first(targets):
+    # Under -j, a long chain (like a big link step) that starts last
+    # stretches out the whole build, so start the targets that took the
+    # longest last time first.  Targets we've never built keep their order,
+    # after all the others.
+    files = [state.File(name=t) for t in targets]
+    times = state.critical_times(files)
+    known = []
+    unknown = []
+    for i,f in enumerate(files):
+        if f.id in times:
+            known.append((-times[f.id], i, targets[i]))
+        else:
+            unknown.append(targets[i])
+    known.sort()
+    return [t for (neg,i,t) in known] + unknown
+
+
+def main(targets, shouldbuildfunc, longest_first=False):
     retcode = [0]  # a list so that it can be reassigned from done()
     if vars.SHUFFLE:
         import random
         random.shuffle(targets)
+    elif longest_first and len(targets) > 1:
+        # only for the targets redo --longest-first was given itself; the
+        # sub-redos of every .do file shouldn't each have to look up the
+        # history of their whole subtree.
+        targets = _longest_first(targets)
 
     locked = []
 
@@ -306,23 +494,27 @@ def main(targets, shouldbuildfunc):
         if rv:
             retcode[0] = 1
 
+    if vars.STAT_THREADS:
+        # get the targets' own stamps out of the way all at once, too.
+        state.prefetch_stats([os.path.join(vars.BASE,
+                                           state.relpath(t, vars.BASE))
+                              for t in targets])
+
     # In the first cycle, we just build as much as we can without worrying
     # about any lock contention.  If someone else has it locked, we move on.
+    #
+    # Checking whether a target is dirty doesn't need a jobserver token,
+    # so when all our tokens are busy, we don't just sit and wait for one:
+    # we go ahead and check the next targets.  Most are usually clean, and
+    # then we're done with them.  But we must never wait for a token while
+    # holding a lock we haven't started a job for (see below), so the dirty
+    # ones give their locks back and queue up in ready, to be started (and
+    # re-checked under the lock) in order as tokens come free.
     seen = {}
-    lock = None
-    for t in targets:
-        if t in seen:
-            continue
-        seen[t] = 1
-        if not jwack.has_token():
-            state.commit()
-        jwack.get_token(t)
-        if retcode[0] and not vars.KEEP_GOING:
-            break
-        if not state.check_sane():
-            err('.redo directory disappeared; cannot continue.\n')
-            retcode[0] = 205
-            break
+    ready = []
+    token_wait = {}  # target -> seconds we waited for a token to build it
+
+    def trylock(t):
         f = state.File(name=t)
         lock = state.Lock(f.id)
         if vars.UNLOCKED:
@@ -333,46 +525,115 @@ def main(targets, shouldbuildfunc):
             if vars.DEBUG_LOCKS:
                 log('%s (locked...)\n' % _nice(t))
             locked.append((f.id,t))
-        else:
-            BuildJob(t, f, lock, shouldbuildfunc, done).start()
+            return None
+        return BuildJob(t, f, lock, shouldbuildfunc, done,
+                        token_wait.pop(t, 0))
 
-    del lock
+    def start_ready():
+        while ready and jwack.try_get_token():
+            job = trylock(ready.pop(0))
+            if job:
+                # someone else might have built it while it was unlocked,
+                # so what we knew about it might be stale.  (What we know
+                # about its deps still holds; if they were dirty before,
+                # they still are.)
+                state.forget_stat(os.path.join(vars.BASE, job.sf.name))
+                job.start()
 
-    # Now we've built all the "easy" ones.  Go back and just wait on the
-    # remaining ones one by one.  There's no reason to do it any more
-    # efficiently, because if these targets were previously locked, that
+    for t in targets:
+        if t in seen:
+            continue
+        seen[t] = 1
+        start_ready()
+        if retcode[0] and not vars.KEEP_GOING:
+            break
+        if not state.check_sane():
+            err('.redo directory disappeared; cannot continue.\n')
+            retcode[0] = 205
+            break
+        job = trylock(t)
+        if not job:
+            pass
+        elif not ready and jwack.try_get_token():
+            job.start()
+        elif job.check():
+            job.lock.unlock()
+            ready.append(t)
+        # let go of job (and its Lock) now; start_ready() might want to
+        # make a new one for the same target.
+        job = None
+
+    while ready and not (retcode[0] and not vars.KEEP_GOING):
+        if not jwack.has_token():
+            state.commit()
+        t = ready[0]
+        token_wait[t] = token_wait.get(t, 0) + jwack.get_token(t)
+        start_ready()
+
+    # Now we've built all the "easy" ones.  The rest were locked, which
     # means someone else was building them; thus, we probably won't need to
-    # do anything.  The only exception is if we're invoked as redo instead
-    # of redo-ifchange; then we have to redo it even if someone else already
-    # did.  But that should be rare.
+    # do anything, but we have to wait and see.  (The only exception is if
+    # we're invoked as redo instead of redo-ifchange; then we have to redo
+    # it even if someone else already did.  But that should be rare.)
+    # Rather than waiting for them one by one, maybe on the one that takes
+    # longest while the others are long done, we wait for all of them (and
+    # for our own jobs) at once, and go on with whichever comes free first.
+    waiter = None
     while locked or jwack.running():
         state.commit()
-        jwack.wait_all()
-        # at this point, we don't have any children holding any tokens, so
-        # it's okay to block below.
-        if retcode[0] and not vars.KEEP_GOING:
+        if not locked or (retcode[0] and not vars.KEEP_GOING):
+            jwack.wait_all()
+            if retcode[0] and not vars.KEEP_GOING:
+                break
+            continue
+        if not state.check_sane():
+            err('.redo directory disappeared; cannot continue.\n')
+            retcode[0] = 205
             break
-        if locked:
-            if not state.check_sane():
-                err('.redo directory disappeared; cannot continue.\n')
-                retcode[0] = 205
+        if not waiter:
+            waiter = state.LockWaiter()
+        if not waiter.usable:
+            # then we can only wait for one lock at a time, the old way:
+            # without a token, and with no children holding any either.
+            jwack.wait_all()
+            if retcode[0] and not vars.KEEP_GOING:
                 break
-            fid,t = locked.pop(0)
+            fid,t = locked[0]
+            if vars.DEBUG_LOCKS:
+                warn('%s (WAITING)\n' % _nice(t))
+            jwack.release_mine()
             lock = state.Lock(fid)
-            lock.trylock()
-            while not lock.owned:
-                if vars.DEBUG_LOCKS:
+            lock.waitlock()
+            lock.unlock()
+            del lock
+            state.forget_stat()  # someone else just built stuff
+            freed = [fid]
+        else:
+            for fid,t in locked:
+                if vars.DEBUG_LOCKS and fid not in waiter.waiting:
                     warn('%s (WAITING)\n' % _nice(t))
-                # this sequence looks a little silly, but the idea is to
-                # give up our personal token while we wait for the lock to
-                # be released; but we should never run get_token() while
-                # holding a lock, or we could cause deadlocks.
+                waiter.watch(fid)
+            freed = waiter.freed()
+        if not freed:
+            # give up our personal token while we wait for a lock to be
+            # released, so someone else can use it.
+            if jwack.has_token():
                 jwack.release_mine()
-                lock.waitlock()
-                lock.unlock()
-                jwack.get_token(t)
-                lock.trylock()
-            assert(lock.owned)
+            jwack.wait(want_token=0, extra_fd=waiter.fd)
+            state.forget_stat()  # someone else just built stuff
+            continue
+        for fid,t in [(fid,t) for (fid,t) in locked if fid in freed]:
+            # we should never run get_token() while holding a lock we
+            # haven't started a job for, or we could cause deadlocks.
+            if not jwack.has_token():
+                state.commit()
+            waited = jwack.get_token(t)
+            lock = state.Lock(fid)
+            lock.trylock()
+            if not lock.owned:
+                del lock
+                continue  # someone beat us to it; keep waiting
+            locked.remove((fid,t))
             if vars.DEBUG_LOCKS:
                 log('%s (...unlocked!)\n' % _nice(t))
             if state.File(name=t).is_failed():
@@ -381,6 +642,15 @@ def main(targets, shouldbuildfunc):
                 lock.unlock()
             else:
                 BuildJob(t, state.File(id=fid), lock,
-                         shouldbuildfunc, done).start()
-    state.commit()
+                         shouldbuildfunc, done, waited).start()
+            del lock
+    if not vars.DEPTH:
+        state.checkpoint()
+    else:
+        state.commit()
+    debug2('stat cache: %d hits, %d misses\n'
+           % (state.stat_hits, state.stat_misses))
+    debug2('database: %.3fs writing\n' % state.write_time)
+    debug2('jobserver: waited for a token %d times, %.3fs in total\n'
+           % (jwack.token_waits, jwack.token_wait_time))
     return retcode[0]
@@ -0,0 +1,379 @@
+#
+# A cache of build results, so that when two checkouts (or two CI runs)
+# build a target from exactly the same inputs, only the first one has to
+# run its .do script; the others just copy the output.
+#
+# We can't know what a .do script depends on until we run it, so the cache
+# holds three kinds of entries:
+#
+#  - a manifest ('m'), keyed by the target's name, its .do file (name and
+#    contents) and the arguments we pass it.  It lists the dependencies the
+#    .do script declared the last time it ran.
+#
+#  - a result ('r'), keyed by the manifest key plus the contents of all of
+#    those dependencies (and whether each redo-ifcreate'd file exists).  It
+#    says whether the target was a file, and if so, its mode and which
+#    object holds its contents.
+#
+#  - an object ('o'), keyed by the sha1 of its own contents.
+#
+# Before running a .do script, the builder looks for a manifest.  If there
+# is one, it brings everything listed there up to date (just like the .do
+# script would have), then computes the result key and looks for that.
+# After a successful build, it stores the object, the result, and the
+# manifest, in that order, so nobody ever sees a result whose object hasn't
+# arrived yet.
+#
+# $REDO_CACHE is either a directory, which we share with anyone else who
+# uses it and keep under $REDO_CACHE_SIZE bytes by throwing out whatever
+# was used least recently, or an http:// URL, which we GET and PUT entries
+# under as URL/<kind>/<key>.
+#
+# Environment variables that a .do script looks at aren't part of any key,
+# so builds that only differ by those shouldn't share a cache.
+#
+import sys, os, errno, fcntl, stat
+import vars, state
+from helpers import unlink, join
+from atoi import atoi
+
+FORMAT = 'redo-cache 1'
+FICLONE = 0x40049409   # from linux/fs.h
+
+
+def _sha1():
+    try:
+        import hashlib
+    except ImportError:
+        import sha  # python 2.4; see redo-stamp.py
+        return sha.sha()
+    else:
+        return hashlib.sha1()
+
+
+def _file_sha1(path):
+    sh = _sha1()
+    f = open(path, 'rb')
+    while 1:
+        b = f.read(1024*1024)
+        if not b: break
+        sh.update(b)
+    f.close()
+    return sh.hexdigest()
+
+
+def _clone(src, dst, mode=0666):
+    """Copy src to a new file dst, sharing its blocks if the filesystem can."""
+    sfd = os.open(src, os.O_RDONLY)
+    try:
+        dfd = os.open(dst, os.O_WRONLY|os.O_CREAT|os.O_EXCL, mode)
+        try:
+            try:
+                fcntl.ioctl(dfd, FICLONE, sfd)
+            except (IOError, OSError):
+                # no reflinks here (eg. ext4 or tmpfs); copy it the slow way
+                while 1:
+                    b = os.read(sfd, 1024*1024)
+                    if not b: break
+                    while b:
+                        b = b[os.write(dfd, b):]
+        finally:
+            os.close(dfd)
+    finally:
+        os.close(sfd)
+
+
+def _size(s):
+    s = s.strip().upper()
+    mult = 1
+    for suffix,m in [('K', 1024), ('M', 1024**2), ('G', 1024**3)]:
+        if s.endswith(suffix):
+            s = s[:-1]
+            mult = m
+    return atoi(s) * mult
+
+
+class DirStore:
+    """Cache entries in a local directory, with least-recently-used eviction.
+
+    Each entry is a file; reading one bumps its mtime, so the oldest mtimes
+    are the ones nobody has wanted for longest.  The 'size' file holds our
+    estimate of the total size, so we don't have to look at every entry
+    every time we add one; only once it goes over maxsize do we go through
+    them all and delete the oldest.
+    """
+    def __init__(self, dir, maxsize):
+        self.dir = dir
+        self.maxsize = maxsize
+
+    def _path(self, kind, key):
+        return os.path.join(self.dir, kind, key[:2], key[2:])
+
+    def fetch(self, kind, key, dest, mode=0666):
+        """Copy entry kind/key into new file dest; false if there isn't one."""
+        p = self._path(kind, key)
+        try:
+            _clone(p, dest, mode)
+        except OSError, e:
+            if e.errno == errno.ENOENT:
+                return False
+            raise
+        try:
+            os.utime(p, None)
+        except OSError:
+            pass  # just got evicted; we already have our copy
+        return True
+
+    def get(self, kind, key):
+        """Return the contents of entry kind/key, or None."""
+        p = self._path(kind, key)
+        try:
+            data = open(p, 'rb').read()
+        except IOError, e:
+            if e.errno == errno.ENOENT:
+                return None
+            raise
+        try:
+            os.utime(p, None)
+        except OSError:
+            pass
+        return data
+
+    def _add(self, kind, key, write):
+        p = self._path(kind, key)
+        try:
+            os.makedirs(os.path.dirname(p))
+        except OSError, e:
+            if e.errno != errno.EEXIST:
+                raise
+        tmp = '%s.%d.tmp' % (p, os.getpid())
+        unlink(tmp)
+        write(tmp)
+        existed = os.path.exists(p)
+        os.rename(tmp, p)
+        if not existed:
+            self._grow(os.stat(p).st_size)
+
+    def store(self, kind, key, src):
+        """Add file src as entry kind/key."""
+        if kind == 'o' and os.path.exists(self._path(kind, key)):
+            # objects are named after their contents, so it's the same one
+            os.utime(self._path(kind, key), None)
+            return
+        self._add(kind, key, lambda tmp: _clone(src, tmp))
+
+    def put(self, kind, key, data):
+        """Add data as entry kind/key."""
+        def write(tmp):
+            f = open(tmp, 'wb')
+            f.write(data)
+            f.close()
+        self._add(kind, key, write)
+
+    def _grow(self, n):
+        fd = os.open(os.path.join(self.dir, 'size'), os.O_RDWR|os.O_CREAT,
+                     0666)
+        try:
+            fcntl.lockf(fd, fcntl.LOCK_EX)
+            size = atoi(os.read(fd, 64)) + n
+            if size > self.maxsize:
+                size = self._evict()
+            os.lseek(fd, 0, 0)
+            os.ftruncate(fd, 0)
+            os.write(fd, str(size))
+        finally:
+            os.close(fd)  # also releases the lock
+
+    def _evict(self):
+        l = []
+        total = 0
+        for kind in 'mro':
+            top = os.path.join(self.dir, kind)
+            try:
+                subdirs = os.listdir(top)
+            except OSError:
+                continue
+            for sub in subdirs:
+                d = os.path.join(top, sub)
+                for name in os.listdir(d):
+                    p = os.path.join(d, name)
+                    try:
+                        st = os.lstat(p)
+                    except OSError:
+                        continue  # someone else got it first
+                    l.append((st.st_mtime, st.st_size, p))
+                    total += st.st_size
+        # go a bit below the limit, so we don't end up doing this again
+        # on the very next entry.
+        goal = self.maxsize * 9 / 10
+        l.sort()
+        for mtime,size,p in l:
+            if total <= goal:
+                break
+            unlink(p)
+            total -= size
+        return total
+
+
+class HttpStore:
+    """Cache entries on an HTTP server, as URL/<kind>/<key>.
+
+    The server only has to answer GET with 200 or 404 and accept PUT; how
+    (and whether) it throws old entries away is its own business.  If it
+    isn't working, we complain once and then just act like the cache is
+    empty.
+    """
+    def __init__(self, url):
+        import urlparse
+        u = urlparse.urlsplit(url)
+        self.host = u[1]
+        self.prefix = u[2].rstrip('/')
+        self.broken = 0
+
+    def _request(self, method, kind, key, body=None):
+        import httplib, socket
+        if self.broken:
+            return None
+        try:
+            conn = httplib.HTTPConnection(self.host)
+            try:
+                conn.request(method, '%s/%s/%s' % (self.prefix, kind, key),
+                             body)
+                resp = conn.getresponse()
+                data = resp.read()
+            finally:
+                conn.close()
+        except (socket.error, httplib.HTTPException), e:
+            from log import warn
+            warn('cache: %s: %s; not using it.\n' % (self.host, e))
+            self.broken = 1
+            return None
+        if method == 'GET' and resp.status == 200:
+            return data
+        elif method == 'PUT' and resp.status < 300:
+            return data
+        elif resp.status != 404:
+            from log import warn
+            warn('cache: %s %s/%s: HTTP error %d\n'
+                 % (method, kind, key, resp.status))
+        return None
+
+    def fetch(self, kind, key, dest, mode=0666):
+        data = self._request('GET', kind, key)
+        if data == None:
+            return False
+        fd = os.open(dest, os.O_WRONLY|os.O_CREAT|os.O_EXCL, mode)
+        try:
+            while data:
+                data = data[os.write(fd, data):]
+        finally:
+            os.close(fd)
+        return True
+
+    def get(self, kind, key):
+        return self._request('GET', kind, key)
+
+    def store(self, kind, key, src):
+        self._request('PUT', kind, key, open(src, 'rb').read())
+
+    def put(self, kind, key, data):
+        self._request('PUT', kind, key, data)
+
+
+_store = None
+def _get_store():
+    global _store
+    if not _store:
+        if vars.CACHE.startswith('http://'):
+            _store = HttpStore(vars.CACHE)
+        else:
+            _store = DirStore(vars.CACHE, _size(vars.CACHE_SIZE or '1G'))
+    return _store
+
+
+def enabled():
+    return vars.CACHE and 1 or 0
+
+
+def manifest_key(sf, dopath, args):
+    """The key for the manifest of target sf, built by dopath with args."""
+    sh = _sha1()
+    sh.update('%s\n%s\n%s\n%s\n%d\n' % (FORMAT, sf.name,
+                                        state.relpath(dopath, vars.BASE),
+                                        _file_sha1(dopath), vars.OLD_ARGS))
+    for a in args:
+        sh.update('%s\n' % a)
+    return sh.hexdigest()
+
+
+def manifest(mkey):
+    """Return the [(mode, name)] deps listed in manifest mkey, or None."""
+    data = _get_store().get('m', mkey)
+    if data == None:
+        return None
+    deps = []
+    for line in data.split('\n')[:-1]:
+        deps.append((line[0], line[2:]))
+    return deps
+
+
+def _dep_hash(mode, name):
+    path = os.path.join(vars.BASE, name)
+    if mode == 'c':
+        return os.path.lexists(path) and 'exists' or '-'
+    f = state.File(name=path)
+    if f.hash and not f.is_generated and f.read_stamp() == f.stamp:
+        return f.hash  # --content-stamps already did the work
+    return f.read_hash() or '-'
+
+
+def _result_key(mkey, deps):
+    sh = _sha1()
+    sh.update(mkey + '\n')
+    for mode,name in deps:
+        sh.update('%s %s %s\n' % (mode, name, _dep_hash(mode, name)))
+    return sh.hexdigest()
+
+
+def restore(mkey, deps, dest):
+    """Fetch the result for deps into dest; false if we don't have it.
+
+    Call this only once everything in deps is up to date.  If the target
+    wasn't a file at all, returns true without creating dest.
+    """
+    store = _get_store()
+    result = store.get('r', _result_key(mkey, deps))
+    if result == None:
+        return False
+    if result == '-\n':
+        return True
+    mode, okey = result.split()
+    return store.fetch('o', okey, dest, int(mode, 8))
+
+
+def add(mkey, sf, path):
+    """Put the target sf, just built into path, into the cache."""
+    deps = []
+    for mode,f in sf.deps():
+        if f.name.startswith(state.DOFILES):
+            continue  # a different .do file would change our mkey anyway
+        if f.name.startswith('//'):
+            return  # eg. redo-always; no cache can answer for that
+        deps.append((mode, f.name))
+    try:
+        st = os.stat(path)
+    except OSError, e:
+        if e.errno != errno.ENOENT:
+            raise
+        st = None
+    store = _get_store()
+    if not st:
+        result = '-\n'
+    elif not stat.S_ISREG(st.st_mode):
+        return  # we only know how to keep files
+    else:
+        okey = _file_sha1(path)
+        store.store('o', okey, path)
+        result = '%o %s\n' % (st.st_mode & 07777, okey)
+    store.put('r', _result_key(mkey, deps), result)
+    store.put('m', mkey, join('', ['%s %s\n' % d for d in deps]))
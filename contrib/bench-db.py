@@ -0,0 +1,74 @@
+#!/usr/bin/env python
+#
+# Compare redo's state database backends (REDO_DB_BACKEND=sqlite and log)
+# on a made-up project: lots of small targets, each depending on a few of
+# a handful of sources.  For each backend, times a full build, a no-op
+# build (which is mostly loading the graph and checking stamps), a build
+# after touching one source, and redo-ood.
+#
+# Usage: bench-db.py [targets [jobs]]
+#
+# Run it from the top of the redo source tree, or with the redo you want
+# to test in your $PATH.
+#
+import sys, os, time, shutil, tempfile, subprocess
+
+ntargets = int(sys.argv[1:2] and sys.argv[1] or 1000)
+jobs = sys.argv[2:3] and sys.argv[2] or '1'
+NSOURCES = 20
+
+here = os.path.abspath(os.path.dirname(sys.argv[0]))
+if os.path.exists(os.path.join(here, '../redo.py')):
+    os.environ['PATH'] = '%s:%s' % (os.path.dirname(here), os.environ['PATH'])
+for k in os.environ.keys():
+    if k.startswith('REDO') or k.startswith('DO_') or k == 'MAKEFLAGS':
+        del os.environ[k]
+
+
+def make_tree(dir):
+    for i in range(NSOURCES):
+        open(os.path.join(dir, 's%d' % i), 'w').write('%d\n' % i)
+    open(os.path.join(dir, 'default.t.do'), 'w').write(
+        'n=${2#t}\n'
+        'a=$((n %% %d)); b=$(((n * 7) %% %d)); c=$(((n * 13) %% %d))\n'
+        'redo-ifchange s$a s$b s$c\n'
+        'cat s$a s$b s$c\n' % (NSOURCES, NSOURCES, NSOURCES))
+    f = open(os.path.join(dir, 'all.do'), 'w')
+    f.write('redo-ifchange \\\n')
+    for i in range(ntargets):
+        f.write('\tt%d.t \\\n' % i)
+    f.write('\n')
+    f.close()
+
+
+def run(dir, backend, *argv):
+    env = dict(os.environ)
+    env['REDO_DB_BACKEND'] = backend
+    devnull = open('/dev/null', 'w')
+    start = time.time()
+    rv = subprocess.call(argv, cwd=dir, env=env, stdout=devnull)
+    took = time.time() - start
+    if rv:
+        sys.stderr.write('%s: %r failed (%d)\n' % (backend, argv, rv))
+        sys.exit(1)
+    return took
+
+
+results = []
+for backend in ['sqlite', 'log']:
+    dir = tempfile.mkdtemp(prefix='redo-bench-')
+    try:
+        make_tree(dir)
+        t = [run(dir, backend, 'redo', '-j%s' % jobs, 'all')]
+        t.append(run(dir, backend, 'redo-ifchange', 'all'))
+        os.utime(os.path.join(dir, 's0'), None)
+        t.append(run(dir, backend, 'redo-ifchange', 'all'))
+        t.append(run(dir, backend, 'redo-ood'))
+        results.append((backend, t))
+    finally:
+        shutil.rmtree(dir)
+
+print '%d targets, -j%s:' % (ntargets, jobs)
+print '%-8s %9s %9s %9s %9s' % ('backend', 'build', 'no-op', 'touch', 'ood')
+for backend,t in results:
+    print '%-8s %8.2fs %8.2fs %8.2fs %8.2fs' % ((backend,) + tuple(t))
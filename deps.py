@@ -1,16 +1,41 @@
 import sys, os
 import vars, state, builder
 from log import debug
+if vars.WATCH:
+    import watch
 
 CLEAN = 0
 DIRTY = 1
 
+def _walks_into(parent, f2, is_checked):
+    # whether isdirty(f2), called for parent, would get as far as looking
+    # at f2's children.
+    return not (f2.failed_runid or f2.changed_runid == None
+                or f2.changed_runid > max(parent.changed_runid,
+                                          parent.checked_runid)
+                or is_checked(f2) or not f2.stamp)
+
+
 def isdirty(f, depth, max_changed,
             is_checked=state.File.is_checked,
-            set_checked=state.File.set_checked_save):
+            set_checked=state.File.set_checked_save,
+            graph=None):
     if vars.DEBUG >= 1:
         debug('%s?%s\n' % (depth, f.nicename()))
+    memo = state.dirty_memo.get(f.id)
+    if memo and max_changed in memo:
+        dirty = memo[max_changed]
+        if vars.DEBUG >= 1:
+            debug('%s-- %s (seen)\n' % (depth, dirty and 'DIRTY' or 'CLEAN'))
+        return dirty
+    children = []  # _isdirty() adds the deps it looks at
+    dirty = _isdirty(f, depth, max_changed, is_checked, set_checked, graph,
+                     children)
+    state.remember_dirty(f, max_changed, dirty, children)
+    return dirty
+
 
+def _isdirty(f, depth, max_changed, is_checked, set_checked, graph, seen):
     if f.failed_runid:
         debug('%s-- DIRTY (failed last time)\n' % depth)
         return DIRTY
@@ -28,7 +53,16 @@ def isdirty(f, depth, max_changed,
         debug('%s-- DIRTY (no stamp)\n' % depth)
         return DIRTY
 
-    newstamp = f.read_stamp()
+    # the last run in which we know f's stamp matched the file on disk
+    verified = max(f.checked_runid, f.changed_runid)
+    if vars.WATCH and watch.unchanged_since(f.name, verified):
+        newstamp = f.stamp
+    else:
+        newstamp = f.read_stamp()
+    if f.stamp != newstamp and f.same_content(newstamp):
+        debug('%s-- (touched, but contents unchanged)\n' % depth)
+        f.stamp = newstamp
+        f.save()  # so we don't have to read it again next time
     if f.stamp != newstamp:
         if newstamp == state.STAMP_MISSING:
             debug('%s-- DIRTY (missing)\n' % depth)
@@ -39,18 +73,35 @@ def isdirty(f, depth, max_changed,
         else:
             return DIRTY
 
+    if graph == None:
+        # load f's dependency tree (as much of it as we'll walk through) at
+        # once, rather than asking the database about each node as we get
+        # to it.  If we already did, for some other target, this is free.
+        def expand(parent, f2):
+            return _walks_into(parent, f2, is_checked)
+        children = state.deps_graph(f, expand=expand)[f.id]
+    else:
+        children = graph.get(f.id, [])
+    seen += children
+    if vars.STAT_THREADS:
+        state.prefetch_stats([os.path.join(vars.BASE, f2.name)
+                              for mode,f2 in children if not is_checked(f2)])
     must_build = []
-    for mode,f2 in f.deps():
+    must_ids = {}
+    for mode,f2 in children:
         dirty = CLEAN
         if mode == 'c':
-            if os.path.exists(os.path.join(vars.BASE, f2.name)):
+            if vars.WATCH and watch.unchanged_since(f2.name, verified):
+                pass  # still doesn't exist, or the daemon would know
+            elif state.exists(os.path.join(vars.BASE, f2.name)):
                 debug('%s-- DIRTY (created)\n' % depth)
                 dirty = DIRTY
         elif mode == 'm':
             sub = isdirty(f2, depth = depth + '  ',
                           max_changed = max(f.changed_runid,
                                             f.checked_runid),
-                          is_checked=is_checked, set_checked=set_checked)
+                          is_checked=is_checked, set_checked=set_checked,
+                          graph=graph)
             if sub:
                 debug('%s-- DIRTY (sub)\n' % depth)
                 dirty = sub
@@ -74,8 +125,12 @@ def isdirty(f, depth, max_changed,
             elif isinstance(dirty,list):
                 # our child f2 might be dirty, but it's not sure yet.  It's
                 # given us a list of targets we have to redo in order to
-                # be sure.
-                must_build += dirty
+                # be sure.  (In a diamond-shaped graph, lots of them can
+                # be the same ones.)
+                for f3 in dirty:
+                    if f3.id not in must_ids:
+                        must_ids[f3.id] = 1
+                        must_build.append(f3)
 
     if must_build:
         # f is *maybe* dirty because at least one of its children is maybe
@@ -0,0 +1,401 @@
+#
+# A state database that's just a log file, like ninja's .ninja_deps, for
+# when sqlite is more database than we need.  (Set REDO_DB_BACKEND=log.)
+#
+# Almost everything redo does with its state is "load the dependencies of
+# these targets and compare their stamps", and for that, thousands of tiny
+# SQL queries cost more than the actual work.  So instead, each process
+# reads the whole log into memory when it starts, answers everything from
+# there, and appends whatever it changed to the end of the log when it
+# commits.
+#
+# The log is a header line followed by batches, one per commit.  Each batch
+# is a length, a crc32, and a marshal'd list of records:
+#
+#   ('n', [names])           give each new name the next file id
+#   ('f', id, <8 columns>)   set a file's row (the Files columns in state.py)
+#   ('c', id, runid)         raise a file's checked_runid to runid
+#   ('d', target, mode, delete_me, [source ids])   add (or replace) deps
+#   ('z', target)            mark all of target's deps delete_me
+#   ('Z', target)            delete target's deps that are marked delete_me
+#   ('h', id, runid, start, wall, utime, stime, maxrss, wait)   a History row
+#   ('r',)                   start a new run
+#   ('S', names, rows, deps, hist, runid)   everything, all at once
+#
+# Lots of redo processes append to the same log at once.  Each batch goes
+# out in a single O_APPEND write(), so they never get mixed up, and the
+# order they land in is the order of the transactions.  Before answering
+# any question, we read whatever the others appended since last time.
+# File ids are handed out by position in the log: the first 'n' record for
+# a name decides its id, so everyone comes up with the same one.  Runids
+# work the same way.
+#
+# Targets get rebuilt over and over, so most of the log is soon out of
+# date.  Every process holds a shared flock() on the log for as long as it
+# has it open; when we open it (or a toplevel redo finishes) and find
+# nobody else does, and less than a third of it is still alive, we replace
+# it with a single 'S' record.  That's just our in-memory tables, so
+# marshal can load it in one go, without looking at every record.
+#
+import os, errno, fcntl, marshal, struct, zlib
+from helpers import close_on_exec
+
+HEADER = 'redo deps log 1\n'
+COMPACT_MIN = 1000   # don't bother compacting anything smaller
+COMPACT_RATIO = 3    # ...or anything that's more than 1/3 alive
+
+_EMPTY = (None,) * 8
+
+
+class DepsLog:
+    def __init__(self, path):
+        self.path = path
+        self.pending = []
+        self.broken = 0
+        while not self._open():
+            pass  # someone compacted it out from under us; try again
+
+    def _reset(self):
+        self.ofs = len(HEADER)
+        self.names = [None]   # file id -> name; ids start at 1
+        self.ids = {}         # name -> file id
+        self.rows = {}        # file id -> the 8 columns after the name
+        self.deps = {}        # target id -> {source id: (mode, delete_me)}
+        self.users = None     # source id -> {target id: 1}, if needed
+        self.hist = {}        # (file id, runid) -> (start, ..., wait)
+        self.runid = 0
+        self.entries = 0      # how many things the log says, live or not
+        self.snapped = 0      # how many of those were in the 'S' record
+
+    def _open(self):
+        fd = os.open(self.path, os.O_RDWR|os.O_APPEND|os.O_CREAT, 0666)
+        close_on_exec(fd, True)
+        self.fd = fd
+        try:
+            fcntl.flock(fd, fcntl.LOCK_EX|fcntl.LOCK_NB)
+            alone = 1
+        except IOError, e:
+            if e.errno not in (errno.EAGAIN, errno.EACCES):
+                raise
+            fcntl.flock(fd, fcntl.LOCK_SH)
+            alone = 0
+        if not self._current():
+            os.close(fd)
+            return False
+        self._reset()
+        head = os.read(fd, len(HEADER))
+        if head != HEADER:
+            if not alone:
+                raise Exception('%s: not a redo deps log' % self.path)
+            if head:
+                from log import warn
+                warn('state database: discarding %s (wanted %r)\n'
+                     % (self.path, HEADER.strip()))
+            os.ftruncate(fd, 0)
+            os.write(fd, HEADER)
+        self._catch_up(alone)
+        if alone:
+            self._maybe_compact()
+        # this isn't atomic, so check that nobody compacted in between
+        fcntl.flock(self.fd, fcntl.LOCK_SH)
+        if not self._current():
+            os.close(self.fd)
+            return False
+        self._catch_up()
+        return True
+
+    def _current(self):
+        try:
+            st = os.stat(self.path)
+        except OSError, e:
+            if e.errno == errno.ENOENT:
+                return False
+            raise
+        return os.fstat(self.fd).st_ino == st.st_ino
+
+    def _live(self):
+        n = len(self.names) - 1 + len(self.rows) + len(self.hist) + 1
+        for d in self.deps.values():
+            n += len(d)
+        return n
+
+    def _maybe_compact(self):
+        # Replaying records one by one is much slower than loading an 'S'
+        # record, so once there are enough of them, it's worth it even if
+        # they're not dead yet.
+        if self.entries - self.snapped > COMPACT_MIN:
+            self._compact()
+        elif (self.entries > COMPACT_MIN
+                and self.entries > self._live() * COMPACT_RATIO):
+            self._compact()
+
+    def _compact(self):
+        recs = [('S', self.names, self.rows, self.deps, self.hist,
+                 self.runid)]
+        tmp = '%s.%d.tmp' % (self.path, os.getpid())
+        fd = os.open(tmp, os.O_RDWR|os.O_APPEND|os.O_CREAT|os.O_TRUNC, 0666)
+        close_on_exec(fd, True)
+        os.write(fd, HEADER)
+        os.write(fd, _batch(recs))
+        # nobody can get at it until we downgrade our lock.
+        fcntl.flock(fd, fcntl.LOCK_EX)
+        os.rename(tmp, self.path)
+        os.close(self.fd)
+        self.fd = fd
+        self.ofs = os.fstat(fd).st_size
+        self.entries = self.snapped = self._live()
+
+    def tidy(self):
+        """Compact the log, if it's worth it and nobody else is using it."""
+        self.commit()
+        try:
+            fcntl.flock(self.fd, fcntl.LOCK_EX|fcntl.LOCK_NB)
+        except IOError, e:
+            if e.errno not in (errno.EAGAIN, errno.EACCES):
+                raise
+        else:
+            self._catch_up(fix=1)
+            self._maybe_compact()
+        # a failed upgrade can drop our shared lock, so always take it
+        # again, and start over if someone compacted in the meantime.
+        fcntl.flock(self.fd, fcntl.LOCK_SH)
+        if not self._current():
+            os.close(self.fd)
+            while not self._open():
+                pass
+
+    def _catch_up(self, fix=0, stop=None):
+        """Apply whatever's been appended since we last looked.
+
+        If stop is given, don't go past the batch that ends there.  If fix
+        is true, we're the only one with the log open, so we can throw away
+        a batch that somebody died in the middle of writing.
+        """
+        if self.broken:
+            return
+        size = os.fstat(self.fd).st_size
+        if size <= self.ofs:
+            return
+        os.lseek(self.fd, self.ofs, 0)
+        buf = ''
+        while len(buf) < size - self.ofs:
+            b = os.read(self.fd, size - self.ofs - len(buf))
+            if not b: break
+            buf += b
+        pos = 0
+        while pos + 8 <= len(buf):
+            (n, crc) = struct.unpack('<II', buf[pos:pos+8])
+            end = pos + 8 + n
+            data = buf[pos+8:end]
+            if len(data) < n or zlib.crc32(data) & 0xffffffff != crc:
+                from log import warn
+                if fix:
+                    warn('%s: truncating a damaged entry at %d\n'
+                         % (self.path, self.ofs + pos))
+                    os.ftruncate(self.fd, self.ofs + pos)
+                elif len(data) == n:
+                    warn('%s: damaged at %d; ignoring the rest\n'
+                         % (self.path, self.ofs + pos))
+                    self.broken = 1
+                # else someone is still writing it
+                break
+            self._apply(marshal.loads(data))
+            pos = end
+            if stop != None and self.ofs + pos >= stop:
+                break
+        self.ofs += pos
+        if pos and self.pending:
+            # Our own changes will land in the log after the ones we just
+            # read, so they have to win here, too.
+            entries = self.entries
+            self._apply(self.pending)
+            self.entries = entries
+
+    def _apply(self, recs):
+        rows = self.rows
+        deps = self.deps
+        users = self.users
+        for r in recs:
+            k = r[0]
+            self.entries += 1
+            if k == 'S':
+                (k, self.names, rows, deps, self.hist, self.runid) = r
+                self.rows = rows
+                self.deps = deps
+                self.users = users = None
+                self.ids = dict(zip(self.names, range(len(self.names))))
+                del self.ids[None]
+                self.entries = self.snapped = self._live()
+            elif k == 'f':
+                rows[r[1]] = r[2:]
+            elif k == 'c':
+                row = rows.get(r[1], _EMPTY)
+                if row[2] == None or row[2] < r[2]:
+                    rows[r[1]] = row[:2] + (r[2],) + row[3:]
+            elif k == 'd':
+                (k, t, mode, delete_me, sources) = r
+                d = deps.setdefault(t, {})
+                for s in sources:
+                    d[s] = (mode, delete_me)
+                    if users != None:
+                        users.setdefault(s, {})[t] = 1
+                self.entries += len(sources) - 1
+            elif k == 'z':
+                d = deps.get(r[1], {})
+                for s,(mode, delete_me) in d.items():
+                    d[s] = (mode, 1)
+            elif k == 'Z':
+                t = r[1]
+                d = deps.get(t, {})
+                for s,(mode, delete_me) in d.items():
+                    if delete_me:
+                        del d[s]
+                        if users != None:
+                            del users[s][t]
+            elif k == 'n':
+                for name in r[1]:
+                    if name not in self.ids:
+                        self.ids[name] = len(self.names)
+                        self.names.append(name)
+                self.entries += len(r[1]) - 1
+            elif k == 'h':
+                self.hist[(r[1], r[2])] = r[3:]
+            elif k == 'r':
+                self.runid += 1
+            else:
+                raise Exception('%s: unknown record %r' % (self.path, k))
+
+    def _append(self, recs):
+        """Write recs to the log right now; return where they end."""
+        b = _batch(recs)
+        if os.write(self.fd, b) != len(b):
+            raise IOError(errno.ENOSPC, 'short write to %s' % self.path)
+        return os.lseek(self.fd, 0, 1)
+
+    def _add(self, rec):
+        self.pending.append(rec)
+        self._apply([rec])
+
+    def commit(self):
+        if self.pending:
+            self._append(self.pending)
+            self.pending = []
+
+    def new_runid(self):
+        end = self._append([('r',)])
+        self._catch_up(stop=end)
+        return self.runid
+
+    def last_runid(self):
+        self._catch_up()
+        return self.runid
+
+    def version(self):
+        # anything anyone commits gets appended, and compacting replaces
+        # the file.
+        st = os.stat(self.path)
+        return (st.st_ino, st.st_size)
+
+    def _cols(self, id):
+        return (id, self.names[id]) + self.rows.get(id, _EMPTY)
+
+    def file(self, id=None, name=None):
+        """Return the Files columns for id (or name), or None."""
+        self._catch_up()
+        if id == None:
+            id = self.ids.get(name)
+        if not id or id >= len(self.names):
+            return None
+        return self._cols(id)
+
+    def files(self):
+        self._catch_up()
+        l = [self._cols(id) for id in range(1, len(self.names))]
+        l.sort(key=lambda cols: cols[1])
+        return l
+
+    def intern(self, names):
+        """Return {name: id}, giving ids to any names that don't have one."""
+        self._catch_up()
+        missing = [n for n in names if n not in self.ids]
+        if missing:
+            self._append([('n', missing)])
+            self._catch_up()
+        out = {}
+        for n in names:
+            out[n] = self.ids[n]
+        return out
+
+    def deps_of(self, targets=None):
+        """Return [(target, mode, source columns)] for the given ids, or all."""
+        self._catch_up()
+        if targets == None:
+            targets = self.deps.keys()
+        out = []
+        for t in targets:
+            d = self.deps.get(t)
+            if d:
+                l = d.items()
+                l.sort()
+                for s,(mode, delete_me) in l:
+                    out.append((t, mode, self._cols(s)))
+        return out
+
+    def users_of(self, sources):
+        """Return the ids of all targets that depend on the given ids."""
+        self._catch_up()
+        if self.users == None:
+            self.users = {}
+            for t,d in self.deps.items():
+                for s in d.keys():
+                    self.users.setdefault(s, {})[t] = 1
+        out = {}
+        for s in sources:
+            out.update(self.users.get(s, {}))
+        return out.keys()
+
+    def save(self, id, row):
+        self._add(('f', id) + tuple(row))
+
+    def set_checked(self, id, runid):
+        self._add(('c', id, runid))
+
+    def add_deps(self, target, mode, sources):
+        self._add(('d', target, mode, 0, sources))
+
+    def zap_deps1(self, target):
+        self._add(('z', target))
+
+    def zap_deps2(self, target):
+        self._add(('Z', target))
+
+    def add_history(self, id, runid, start, wall, utime, stime, maxrss,
+                    wait):
+        self._add(('h', id, runid, start, wall, utime, stime, maxrss, wait))
+
+    def history(self, runid=None):
+        self._catch_up()
+        if runid == None:
+            runid = max([r for (id, r) in self.hist.keys()] or [None])
+        h = {}
+        for (id, r),row in self.hist.items():
+            if r == runid:
+                h[id] = (tuple(row) + (None,))[:6]  # older ones had no wait
+        return runid, h
+
+    def last_history(self, ids):
+        """Return {id: (runid, start, wall)} from each id's latest run."""
+        self._catch_up()
+        want = {}
+        for id in ids:
+            want[id] = 1
+        last = {}
+        for (id, r),row in self.hist.items():
+            if id in want and (id not in last or last[id][0] < r):
+                last[id] = (r, row[0], row[1])
+        return last
+
+
+def _batch(recs):
+    data = marshal.dumps(recs)
+    return struct.pack('<II', len(data), zlib.crc32(data) & 0xffffffff) + data
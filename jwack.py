@@ -1,14 +1,19 @@
 #
 # beware the jobberwack
 #
-import sys, os, errno, select, fcntl, signal
+import sys, os, errno, select, fcntl, signal, time
 from helpers import atoi, close_on_exec
 
 _toplevel = 0
 _mytokens = 1
 _fds = None
+_nbfd = None
 _waitfds = {}
 
+# how many times get_token() had to wait for a token, and for how long
+token_waits = 0
+token_wait_time = 0.0
+
 
 def _debug(s):
     if 0:
@@ -27,6 +32,7 @@ def _release(n):
 def release_mine():
     global _mytokens
     assert(_mytokens >= 1)
+    setup(1)
     os.write(_fds[1], 't')
     _mytokens -= 1
 
@@ -44,9 +50,30 @@ def _make_pipe(startfd):
     return fds
 
 
+def _reopen_nonblock(fd):
+    # The jobserver pipe is shared with GNU make, which can't handle it being
+    # non-blocking, so we can't just set O_NONBLOCK on it.  But on Linux, we
+    # can open the same pipe again through /proc, and get a file
+    # description of our very own, which can be as non-blocking as we like.
+    try:
+        nfd = os.open('/proc/self/fd/%d' % fd, os.O_RDONLY | os.O_NONBLOCK)
+    except OSError:
+        return None
+    close_on_exec(nfd, True)
+    return nfd
+
+
 def _try_read(fd, n):
-    # using djb's suggested way of doing non-blocking reads from a blocking
-    # socket: http://cr.yp.to/unix/nonblock.html
+    if _nbfd != None:
+        try:
+            b = os.read(_nbfd, n)
+        except OSError, e:
+            if e.errno in (errno.EAGAIN, errno.EINTR):
+                return ''  # someone else got there first; try again
+            raise
+        return b and b or None  # None means EOF
+    # Otherwise, use djb's suggested way of doing non-blocking reads from a
+    # blocking socket: http://cr.yp.to/unix/nonblock.html
     # We can't just make the socket non-blocking, because we want to be
     # compatible with GNU Make, and they can't handle it.
     r,w,x = select.select([fd], [], [], 0)
@@ -71,17 +98,36 @@ def _try_read(fd, n):
     return b and b or None  # None means EOF
 
 
+def _jobserver_arg():
+    flags = ' ' + os.getenv('MAKEFLAGS', '') + ' '
+    # newer versions of GNU make say --jobserver-auth instead of
+    # --jobserver-fds, and might give a named fifo instead of two fds.
+    for FIND in (' --jobserver-auth=', ' --jobserver-fds='):
+        ofs = flags.find(FIND)
+        if ofs >= 0:
+            s = flags[ofs+len(FIND):]
+            return s.split(' ', 1)[0]
+    return None
+
+
 def setup(maxjobs):
-    global _fds, _toplevel
+    global _fds, _nbfd, _toplevel
     if _fds:
         return  # already set up
     _debug('setup(%d)\n' % maxjobs)
-    flags = ' ' + os.getenv('MAKEFLAGS', '') + ' '
-    FIND = ' --jobserver-fds='
-    ofs = flags.find(FIND)
-    if ofs >= 0:
-        s = flags[ofs+len(FIND):]
-        (arg,junk) = s.split(' ', 1)
+    arg = _jobserver_arg()
+    if arg and arg.startswith('fifo:'):
+        try:
+            a = os.open(arg[5:], os.O_RDONLY | os.O_NONBLOCK)
+            b = os.open(arg[5:], os.O_WRONLY)
+        except OSError, e:
+            raise ValueError('broken --jobserver-auth from make: %r: %s'
+                             % (arg, e))
+        close_on_exec(a, True)
+        close_on_exec(b, True)
+        _fds = (a,b)
+        _nbfd = a
+    elif arg:
         (a,b) = arg.split(',', 1)
         a = atoi(a)
         b = atoi(b)
@@ -96,33 +142,128 @@ def setup(maxjobs):
             else:
                 raise
         _fds = (a,b)
+        _nbfd = _reopen_nonblock(a)
     if maxjobs and not _fds:
         # need to start a new server
         _toplevel = maxjobs
         _fds = _make_pipe(100)
+        _nbfd = _reopen_nonblock(_fds[0])
         _release(maxjobs-1)
-        os.putenv('MAKEFLAGS',
-                  '%s --jobserver-fds=%d,%d -j' % (os.getenv('MAKEFLAGS'),
-                                                    _fds[0], _fds[1]))
+        os.environ['MAKEFLAGS'] = ('%s --jobserver-fds=%d,%d -j'
+                                   % (os.getenv('MAKEFLAGS'),
+                                      _fds[0], _fds[1]))
+
+
+# Each running job has an fd in _waitfds that becomes readable when it
+# exits: a pidfd, if the kernel has those, or else the read end of a pipe
+# whose write end only the child has.  We wait for them with epoll (or at
+# least poll) if we can.  select() has to be handed the whole list every
+# time, and falls over completely past FD_SETSIZE (usually 1024) fds,
+# which is easy to reach with a big -j.
+_poller = None
+_POLLIN = 0
+_POLLUNIT = 1  # epoll timeouts are in seconds, poll ones in milliseconds
+def _poll_setup():
+    global _poller, _POLLIN, _POLLUNIT
+    if _poller != None:
+        return
+    if hasattr(select, 'epoll'):
+        _poller = select.epoll()
+        close_on_exec(_poller.fileno(), True)
+        _POLLIN = select.EPOLLIN
+    elif hasattr(select, 'poll'):
+        _poller = select.poll()
+        _POLLIN = select.POLLIN
+        _POLLUNIT = 1000
+    else:
+        _poller = 0  # just use select()
+
+
+def _unwatch(fd):
+    # we have to do this before closing fd: if a child we forked in the
+    # meantime still has a copy, epoll would keep reporting it.
+    if _poller:
+        _poller.unregister(fd)
+    os.close(fd)
+
+
+# The pidfd_open() syscall has the same number on all these, and python 2
+# doesn't know about it, so we have to call it through ctypes.
+_PIDFD_MACHINES = ['x86_64', 'i386', 'i486', 'i586', 'i686', 'aarch64',
+                   'armv6l', 'armv7l', 'ppc64', 'ppc64le', 's390x', 'riscv64']
+_pidfd_open = None
+def _pidfd_setup():
+    global _pidfd_open
+    if _pidfd_open != None:
+        return _pidfd_open
+    _pidfd_open = 0
+    if (not sys.platform.startswith('linux')
+          or os.uname()[4] not in _PIDFD_MACHINES):
+        return _pidfd_open
+    try:
+        import ctypes
+        libc = ctypes.CDLL(None, use_errno=True)
+        syscall = libc.syscall
+    except (ImportError, OSError, AttributeError):
+        return _pidfd_open
+    def pidfd_open(pid):
+        fd = syscall(434, pid, 0)
+        if fd < 0:
+            e = ctypes.get_errno()
+            raise OSError(e, os.strerror(e))
+        return fd
+    try:
+        os.close(pidfd_open(os.getpid()))
+    except OSError:
+        pass  # kernel is older than 5.3
+    else:
+        _pidfd_open = pidfd_open
+    return _pidfd_open
 
 
-def wait(want_token):
-    rfds = _waitfds.keys()
+def wait(want_token, extra_fd=None, timeout=None):
+    """Wait for a job to finish (or a token, or extra_fd to be readable).
+
+    If timeout (in seconds) is given, give up after that long.  With
+    timeout=0, just reap any jobs that are already done.
+    """
+    _poll_setup()
+    tokfd = None
     if _fds and want_token:
-        rfds.append(_fds[0])
-    assert(rfds)
-    r,w,x = select.select(rfds, [], [])
+        tokfd = (_nbfd != None) and _nbfd or _fds[0]
+    assert(_waitfds or tokfd != None or extra_fd != None
+           or timeout != None)
+    extras = [fd for fd in [tokfd, extra_fd] if fd != None]
+    if _poller:
+        for fd in extras:
+            _poller.register(fd, _POLLIN)
+        try:
+            if timeout == None:
+                r = [fd for fd,ev in _poller.poll()]
+            else:
+                r = [fd for fd,ev in _poller.poll(timeout * _POLLUNIT)]
+        finally:
+            for fd in extras:
+                _poller.unregister(fd)
+    else:
+        rfds = _waitfds.keys() + extras
+        r,w,x = select.select(rfds, [], [], timeout)
     _debug('_fds=%r; wfds=%r; readable: %r\n' % (_fds, _waitfds, r))
     for fd in r:
-        if _fds and fd == _fds[0]:
+        if fd in extras:
             pass
         else:
             pd = _waitfds[fd]
             _debug("done: %r\n" % pd.name)
             _release(1)
-            os.close(fd)
+            _unwatch(fd)
             del _waitfds[fd]
-            rv = os.waitpid(pd.pid, 0)
+            if hasattr(os, 'wait4'):
+                rv = os.wait4(pd.pid, 0)
+                pd.rusage = rv[2]
+            else:
+                rv = os.waitpid(pd.pid, 0)  # python 2.4
+            pd.end = time.time()
             assert(rv[0] == pd.pid)
             _debug("done1: rv=%r\n" % (rv,))
             rv = rv[1]
@@ -140,9 +281,15 @@ def has_token():
 
 
 def get_token(reason):
-    global _mytokens
+    """Wait until we have a token; return how many seconds that took."""
+    global _mytokens, token_waits, token_wait_time
     assert(_mytokens <= 1)
     setup(1)
+    start = None
+    waited = 0
+    if _mytokens < 1:
+        token_waits += 1
+        start = time.time()
     while 1:
         if _mytokens >= 1:
             _debug("_mytokens is %d\n" % _mytokens)
@@ -163,7 +310,28 @@ def get_token(reason):
                 _mytokens += 1
                 _debug('(%r) got a token (%r).\n' % (reason, b))
                 break
+    if start != None:
+        waited = time.time() - start
+        token_wait_time += waited
     assert(_mytokens <= 1)
+    return waited
+
+
+def try_get_token():
+    """Like get_token(), but return False instead of waiting for one."""
+    global _mytokens
+    assert(_mytokens <= 1)
+    setup(1)
+    if _mytokens < 1 and _waitfds:
+        wait(want_token=0, timeout=0)  # finished jobs give their tokens back
+    if _mytokens < 1 and _fds:
+        b = _try_read(_fds[0], 1)
+        if b == None:
+            raise Exception('unexpected EOF on token read')
+        if b:
+            _mytokens += 1
+            _debug('(try) got a token (%r).\n' % b)
+    return _mytokens >= 1
 
 
 def running():
@@ -214,35 +382,149 @@ class Job:
         self.pid = pid
         self.rv = None
         self.donefunc = donefunc
+        # filled in when it's done, for anyone who wants to know how it went
+        self.start = time.time()
+        self.end = None
+        self.rusage = None
         
     def __repr__(self):
         return 'Job(%s,%d)' % (self.name, self.pid)
 
-            
-def start_job(reason, jobfunc, donefunc):
+
+def _start(reason, launch, donefunc):
     global _mytokens
     assert(_mytokens <= 1)
     get_token(reason)
     assert(_mytokens >= 1)
     assert(_mytokens == 1)
     _mytokens -= 1
-    r,w = _make_pipe(50)
-    pid = os.fork()
-    if pid == 0:
-        # child
-        os.close(r)
-        rv = 201
-        try:
-            try:
-                rv = jobfunc() or 0
-                _debug('jobfunc completed (%r, %r)\n' % (jobfunc,rv))
-            except Exception:
-                import traceback
-                traceback.print_exc()
-        finally:
-            _debug('exit: %d\n' % rv)
-            os._exit(rv)
-    close_on_exec(r, True)
-    os.close(w)
+    _poll_setup()
+    pidfd_open = _pidfd_setup()
+    r = w = None
+    if not pidfd_open:
+        r,w = _make_pipe(50)
+        close_on_exec(r, True)
+    try:
+        pid = launch(r)
+    except:
+        _mytokens += 1
+        if w != None:
+            os.close(r)
+            os.close(w)
+        raise
+    if pidfd_open:
+        # pid is our child, so it can't be reaped (and its pid reused)
+        # until we wait() for it.
+        r = pidfd_open(pid)
+    else:
+        os.close(w)
     pd = Job(reason, pid, donefunc)
     _waitfds[r] = pd
+    if _poller:
+        _poller.register(r, _POLLIN)
+    return pd
+
+
+def _forker(jobfunc):
+    def launch(r):
+        pid = os.fork()
+        if pid == 0:
+            # child
+            if r != None:
+                os.close(r)
+            rv = 201
+            try:
+                try:
+                    rv = jobfunc() or 0
+                    _debug('jobfunc completed (%r, %r)\n' % (jobfunc,rv))
+                except Exception:
+                    import traceback
+                    traceback.print_exc()
+            finally:
+                _debug('exit: %d\n' % rv)
+                os._exit(rv)
+        return pid
+    return launch
+
+
+def start_job(reason, jobfunc, donefunc):
+    return _start(reason, _forker(jobfunc), donefunc)
+
+
+# fork() has to copy our page tables (and then take a copy-on-write fault
+# for every page either of us touches before the child gets to exec()),
+# which gets slow once we're holding a big sqlite cache and dependency
+# graph.  posix_spawn() (which glibc implements with vfork) avoids all
+# that, but python 2 has no wrapper for it, so we call it through ctypes.
+# We need posix_spawn_file_actions_addchdir_np() to set the child's
+# directory, which only glibc 2.29+ and musl 1.1.24+ have; anywhere else,
+# we stick with fork().
+_spawn = None
+def _spawn_setup():
+    global _spawn
+    if _spawn != None:
+        return _spawn
+    _spawn = 0
+    try:
+        import ctypes
+        libc = ctypes.CDLL(None, use_errno=True)
+        posix_spawnp = libc.posix_spawnp
+        fa_init = libc.posix_spawn_file_actions_init
+        fa_destroy = libc.posix_spawn_file_actions_destroy
+        fa_adddup2 = libc.posix_spawn_file_actions_adddup2
+        fa_addchdir = libc.posix_spawn_file_actions_addchdir_np
+    except (ImportError, OSError, AttributeError):
+        return _spawn
+    def cstrings(l):
+        a = (ctypes.c_char_p * (len(l)+1))()
+        a[:len(l)] = l
+        return a
+    def check(e, what):
+        if e:
+            raise OSError(e, '%s: %s' % (what, os.strerror(e)))
+    def spawn(argv, env, cwd, stdout):
+        # bigger than any posix_spawn_file_actions_t we know of
+        fa = ctypes.create_string_buffer(256)
+        check(fa_init(fa), 'posix_spawn_file_actions_init')
+        try:
+            if cwd:
+                check(fa_addchdir(fa, cwd), cwd)
+            if stdout != None:
+                check(fa_adddup2(fa, stdout, 1), 'dup2')
+            pid = ctypes.c_int()
+            envl = ['%s=%s' % kv for kv in env.items()]
+            check(posix_spawnp(ctypes.byref(pid), argv[0], fa, None,
+                               cstrings(argv), cstrings(envl)), argv[0])
+        finally:
+            fa_destroy(fa)
+        return pid.value
+    _spawn = spawn
+    return _spawn
+
+
+def spawn_job(reason, argv, env, cwd, stdout, donefunc):
+    """Like start_job(), but the job is just running argv.
+
+    The child gets environment env, starts in directory cwd (if given),
+    and has fd stdout (if given) as its stdout.  Since the child doesn't
+    need to run any of our own code before the exec, we don't have to
+    fork() a copy of ourselves.
+    """
+    spawn = _spawn_setup()
+    def run():
+        if cwd:
+            os.chdir(cwd)
+        if stdout != None:
+            os.dup2(stdout, 1)
+            close_on_exec(1, False)
+        os.execvpe(argv[0], argv, env)
+        assert(0)
+        # returns only if there's an exception
+    def launch(r):
+        if spawn:
+            try:
+                return spawn(argv, env, cwd, stdout)
+            except OSError:
+                pass  # eg. no such program; let run() complain
+        return _forker(run)(r)
+    return _start(reason, launch, donefunc)
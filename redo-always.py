@@ -8,8 +8,10 @@ try:
     me = os.path.join(vars.STARTDIR, 
                       os.path.join(vars.PWD, vars.TARGET))
     f = state.File(name=me)
+    f.defer = True  # our parent will save it for us
     f.add_dep('m', state.ALWAYS)
     always = state.File(name=state.ALWAYS)
+    always.defer = True
     always.stamp = state.STAMP_MISSING
     always.set_changed()
     always.save()
@@ -2,7 +2,8 @@
 import sys, os
 
 import vars_init
-vars_init.init(sys.argv[1:])
+if vars_init.init(sys.argv[1:], check_snapshot=True):
+    sys.exit(0)  # nothing changed since last time; see snapshot.py
 
 import vars, state, builder, jwack, deps
 from helpers import unlink
@@ -22,6 +23,7 @@ try:
         me = os.path.join(vars.STARTDIR, 
                           os.path.join(vars.PWD, vars.TARGET))
         f = state.File(name=me)
+        f.defer = True  # our parent will save it for us
         debug2('TARGET: %r %r %r\n' % (vars.STARTDIR, vars.PWD, vars.TARGET))
     else:
         f = me = None
@@ -29,13 +31,14 @@ try:
     try:
         targets = sys.argv[1:]
         if f:
-            for t in targets:
-                f.add_dep('m', t)
-            f.save()
+            f.add_deps('m', targets)
         rv = builder.main(targets, should_build)
     finally:
         jwack.force_return_tokens()
 except KeyboardInterrupt:
     sys.exit(200)
 state.commit()
+if rv == 0 and not vars.DEPTH:
+    import snapshot
+    snapshot.save(sys.argv[1:])
 sys.exit(rv)
@@ -8,12 +8,12 @@ try:
     me = os.path.join(vars.STARTDIR, 
                       os.path.join(vars.PWD, vars.TARGET))
     f = state.File(name=me)
+    f.defer = True  # our parent will save it for us
     for t in sys.argv[1:]:
         if os.path.exists(t):
             err('redo-ifcreate: error: %r already exists\n' % t)
             sys.exit(1)
-        else:
-            f.add_dep('c', t)
+    f.add_deps('c', sys.argv[1:])
     state.commit()
 except KeyboardInterrupt:
     sys.exit(200)
@@ -21,8 +21,13 @@ def set_checked(f):
     cache[f.id] = 1
 
 
+graph = state.deps_graph()
+if vars.WATCH:
+    import watch
+    watch.prefetch([f.name for f in state.files()])
 for f in state.files():
     if f.is_generated and f.read_stamp() != state.STAMP_MISSING:
         if deps.isdirty(f, depth='', max_changed=vars.RUNID,
-                        is_checked=is_checked, set_checked=set_checked):
+                        is_checked=is_checked, set_checked=set_checked,
+                        graph=graph):
             print f.nicename()
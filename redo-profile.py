@@ -0,0 +1,127 @@
+#!/usr/bin/env python
+import sys, os
+import options
+
+optspec = """
+redo-profile [options...]
+--
+n,count=   number of slowest targets to list [10]
+r,runid=   report on this run instead of the most recent one
+"""
+o = options.Options(optspec)
+(opt, flags, extra) = o.parse(sys.argv[1:])
+
+if extra:
+    o.fatal('no arguments expected')
+
+import vars_init
+vars_init.init([])
+
+import state
+from helpers import atoi
+
+runid, hist = state.history(opt.runid and atoi(opt.runid) or None)
+if not hist:
+    sys.stderr.write('redo-profile: no build history recorded.\n')
+    sys.exit(1)
+
+files = {}
+for f in state.files():
+    if f.id in hist:
+        files[f.id] = f
+graph = state.deps_graph()
+
+def built_deps(t):
+    for mode,f2 in graph.get(t, []):
+        if mode == 'm' and f2.id in hist and f2.id != t:
+            yield f2.id
+
+# The times for each target include everything its .do file ran, which
+# includes building any of its dependencies that weren't up to date.  To
+# see what the target itself cost, take out the dependencies that got built
+# while it was running.  (If someone else was building one of them, we were
+# waiting for its lock, which doesn't count either.)
+self_wall = {}
+self_cpu = {}
+for t,(start, wall, utime, stime, maxrss, wait) in hist.items():
+    cpu = (utime or 0) + (stime or 0)
+    deps = []
+    for d in built_deps(t):
+        (dstart, dwall, dutime, dstime, dmaxrss, dwait) = hist[d]
+        deps.append((dstart, dwall))
+        if dstart >= start and dstart + dwall <= start + wall:
+            cpu -= (dutime or 0) + (dstime or 0)
+    self_wall[t] = state.own_time(start, wall, deps)
+    self_cpu[t] = max(cpu, 0)
+
+
+def name(t):
+    return files[t].nicename()
+
+
+print 'slowest targets in run %d:' % runid
+print '%9s %9s %9s %9s %9s  %s' % ('self', 'total', 'cpu', 'maxrss', 'wait',
+                                   'target')
+l = hist.keys()
+l.sort(key=lambda t: -self_wall[t])
+for t in l[:atoi(opt.count or 10)]:
+    print '%8.2fs %8.2fs %8.2fs %8dk %8.2fs  %s' % (self_wall[t], hist[t][1],
+                                                  self_cpu[t], hist[t][4] or 0,
+                                                  hist[t][5] or 0, name(t))
+
+# A target's times start when its .do does, so they don't include waiting
+# for a jobserver token first.  If there's a lot of that, a bigger -j would
+# have helped.
+waits = [hist[t][5] for t in hist if hist[t][5]]
+print
+print 'waited for a jobserver token: %d times, %.2fs in total' \
+    % (len(waits), sum(waits))
+
+print
+print 'cpu time by directory:'
+dirs = {}
+for t in hist:
+    d = os.path.dirname(name(t)) or '.'
+    dirs[d] = dirs.get(d, 0) + self_cpu[t]
+l = dirs.items()
+l.sort(key=lambda (d,cpu): -cpu)
+for d,cpu in l:
+    print '%8.2fs  %s' % (cpu, d)
+
+# The critical path is the chain of targets, each one depending on the
+# next, that took the longest; no amount of parallelism could have built
+# the whole thing any faster than that.
+#
+# The chains can be longer than python's recursion limit, so we walk them
+# with our own stack.  longest[t] is None while we're still working on the
+# targets beneath t, which makes a cycle count as nothing.
+longest = {}
+def critical(top):
+    stack = [top]
+    while stack:
+        t = stack[-1]
+        if t not in longest:
+            longest[t] = None
+            stack += [d for d in built_deps(t) if d not in longest]
+            continue
+        stack.pop()
+        if longest[t] == None:
+            best = (self_wall[t], None)
+            for d in built_deps(t):
+                sub = (longest[d] or (0, None))[0] + self_wall[t]
+                if sub > best[0]:
+                    best = (sub, d)
+            longest[t] = best
+    return longest[top]
+
+top = None
+for t in hist:
+    if top == None or critical(t)[0] > critical(top)[0]:
+        top = t
+print
+print 'critical path: %.2fs' % critical(top)[0]
+depth = ''
+while top != None:
+    print '%8.2fs  %s%s' % (self_wall[top], depth, name(top))
+    depth += '  '
+    top = longest[top][1]
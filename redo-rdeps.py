@@ -0,0 +1,28 @@
+#!/usr/bin/env python
+import sys, os
+import options
+
+optspec = """
+redo-rdeps [options...] <files...>
+--
+t,targets  only list targets (files that redo generates), not sources
+"""
+o = options.Options(optspec)
+(opt, flags, extra) = o.parse(sys.argv[1:])
+
+if not extra:
+    o.fatal('at least one filename expected')
+
+import vars_init
+vars_init.init(extra)
+
+import state
+
+l = state.rdeps([state.File(name=t) for t in extra])
+l.sort(key=lambda f: f.name)
+for f in l:
+    if f.name.startswith('//'):
+        continue  # special name, ignore
+    if opt.targets and not f.is_generated:
+        continue
+    print f.nicename()
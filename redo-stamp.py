@@ -36,10 +36,12 @@ if not vars.TARGET:
 me = os.path.join(vars.STARTDIR, 
                   os.path.join(vars.PWD, vars.TARGET))
 f = state.File(name=me)
+f.defer = True  # our parent will save it for us
 changed = (csum != f.csum)
 debug2('%s: old = %s\n' % (f.name, f.csum))
 debug2('%s: sum = %s (%s)\n' % (f.name, csum,
                                 changed and 'changed' or 'unchanged'))
+state.forget_stat(os.path.join(vars.BASE, f.name))
 f.is_generated = True
 f.is_override = False
 f.failed_runid = None
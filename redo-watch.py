@@ -0,0 +1,17 @@
+#!/usr/bin/env python
+import sys, os
+
+import vars_init
+vars_init.init([])
+
+import watch
+from log import err
+
+if len(sys.argv[1:]) != 0:
+    err('%s: no arguments expected.\n' % sys.argv[0])
+    sys.exit(1)
+
+try:
+    sys.exit(watch.serve())
+except KeyboardInterrupt:
+    sys.exit(200)
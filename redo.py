@@ -12,6 +12,10 @@ v,verbose  print commands as they are read from .do files (variables intact)
 x,xtrace   print commands as they are executed (variables expanded)
 k,keep-going  keep going as long as possible even if some targets fail
 shuffle    randomize the build order to find dependency bugs
+longest-first  build the targets that took longest last time first
+stat-threads=  stat() this many files at once when checking dependencies
+content-stamps  consider source files changed only if their contents change
+cache=     reuse build results from this directory or http:// URL
 debug-locks  print messages about file locking (useful for debugging)
 debug-pids   print process ids as part of log messages (useful for debugging)
 version    print the current version and exit
@@ -36,6 +40,14 @@ if opt.keep_going:
     os.environ['REDO_KEEP_GOING'] = '1'
 if opt.shuffle:
     os.environ['REDO_SHUFFLE'] = '1'
+if opt.stat_threads:
+    os.environ['REDO_STAT_THREADS'] = str(atoi(opt.stat_threads))
+if opt.content_stamps:
+    os.environ['REDO_CONTENT_STAMPS'] = '1'
+if opt.cache:
+    if not opt.cache.startswith('http://'):
+        opt.cache = os.path.abspath(opt.cache)
+    os.environ['REDO_CACHE'] = opt.cache
 if opt.debug_locks:
     os.environ['REDO_DEBUG_LOCKS'] = '1'
 if opt.debug_pids:
@@ -58,13 +70,17 @@ try:
                      % f.nicename())
     
     j = atoi(opt.jobs or 1)
-    if j < 1 or j > 1000:
+    if j < 1 or j > 10000:
         err('invalid --jobs value: %r\n' % opt.jobs)
     jwack.setup(j)
     try:
-        retcode = builder.main(targets, lambda t: True)
+        retcode = builder.main(targets, lambda t: True,
+                               longest_first=opt.longest_first)
     finally:
         jwack.force_return_tokens()
+    if retcode == 0 and not vars.DEPTH:
+        import snapshot
+        snapshot.save(targets)
     sys.exit(retcode)
 except KeyboardInterrupt:
     sys.exit(200)
@@ -0,0 +1,129 @@
+#
+# A snapshot of everything a toplevel build depended on, so that when
+# nothing has changed (by far the most common case), the next run can find
+# that out without touching the database at all.
+#
+# After a successful toplevel redo or redo-ifchange, we walk the whole
+# dependency graph of its targets and write down the stamp of every file
+# in it (targets, sources, .do files, and the directory listings from
+# state.dofiles()), and the name of every file whose absence it depended
+# on (redo-ifcreate).  The next toplevel redo-ifchange of the same targets
+# from the same directory just compares all that with the filesystem.  If
+# it all matches, it exits right away: no database, no locks, no forking.
+# If anything at all differs, it does a normal build, which will write a
+# new snapshot afterwards.
+#
+# Stamps only tell us about files changing, not about what happened in the
+# database.  So state.commit() throws the snapshot away whenever anyone
+# commits a change to a file's stamp, state or dependencies, whichever
+# build path, directory or process it came from.  That also means a
+# snapshot that's still there when we're done is still right, and we don't
+# have to write it again.  We don't take one if anything in the graph
+# failed, or depends on redo-always.
+#
+import os, errno, marshal
+import vars, state
+from helpers import unlink
+
+FORMAT = 'redo-snapshot 2'
+
+
+def _path():
+    return os.path.join(vars.BASE, state.SNAPSHOT)
+
+
+def _key(targets):
+    return (FORMAT, [os.getcwd()] + list(targets))
+
+
+def _load(all):
+    """Return the snapshot's key, and if all is true, its contents too."""
+    try:
+        f = open(_path(), 'rb')
+    except IOError, e:
+        if e.errno == errno.ENOENT:
+            return None
+        raise
+    try:
+        try:
+            # the key comes first, so a snapshot of something else
+            # doesn't cost us the whole thing.
+            key = marshal.load(f)
+            if not all:
+                return key
+            return (key, marshal.load(f))
+        except (EOFError, ValueError, TypeError):
+            return None
+    finally:
+        f.close()
+
+
+def forget():
+    """Throw away the snapshot."""
+    unlink(_path())
+
+
+def unchanged(targets):
+    """Return true if the snapshot says targets are all up to date."""
+    if _load(False) != _key(targets):
+        return False
+    l = _load(True)
+    if not l:
+        return False
+    (key, (stamps, missing)) = l
+    if vars.STAT_THREADS:
+        state.prefetch_stats([os.path.join(vars.BASE, name)
+                              for name in stamps.keys() + missing])
+    # if it's wrong now, it'll still be wrong next time, even if the build
+    # turns out not to change anything; save() has to take a new one.
+    for name in missing:
+        if state.exists(os.path.join(vars.BASE, name)):
+            forget()
+            return False
+    for name,stamp in stamps.iteritems():
+        if state.read_stamp(name) != stamp:
+            forget()
+            return False
+    return True
+
+
+def save(targets):
+    """Take a snapshot of what targets depend on, now that they're built."""
+    if not targets or not state.check_sane():
+        return
+    if _load(False) == _key(targets):
+        return  # nobody has changed anything since we took it
+    # Every file in the graph was either built or checked during this run,
+    # so the stamps in the database are the ones we just saw; no need to
+    # stat anything again.  If one has changed since, it won't match next
+    # time, which is just a normal build.
+    ver = state.version()
+    files = [state.File(name=t) for t in targets]
+    graph = state.deps_graph(files)
+    stamps = {}
+    missing = {}
+    while files:
+        f = files.pop()
+        if f.name in stamps:
+            continue
+        if f.name == state.ALWAYS or f.failed_runid or not f.stamp:
+            return
+        stamps[f.name] = f.stamp
+        for mode,f2 in graph.get(f.id, []):
+            if mode == 'c':
+                missing[f2.name] = 1
+            else:
+                files.append(f2)
+    tmpname = '%s.%d.tmp' % (_path(), os.getpid())
+    f = open(tmpname, 'wb')
+    try:
+        marshal.dump(_key(targets), f)
+        marshal.dump((stamps, missing.keys()), f)
+    finally:
+        f.close()
+    os.rename(tmpname, _path())
+    if state.version() != ver:
+        # someone committed something after we read the graph, and since
+        # they might have thrown away the old snapshot before we wrote
+        # ours, we can't tell if it's still right.
+        forget()
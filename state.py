@@ -1,27 +1,66 @@
-import sys, os, errno, glob, stat, fcntl, sqlite3
+import sys, os, errno, glob, stat, fcntl, time, marshal
 import vars
-from helpers import unlink, close_on_exec, join
+from helpers import unlink, close_on_exec, join, atoi
 from log import warn, err, debug2, debug3
+if vars.WATCH:
+    import watch
 
-SCHEMA_VER=1
+SCHEMA_VER=6
 TIMEOUT=60
 
 ALWAYS='//ALWAYS'   # an invalid filename that is always marked as dirty
+DOFILES='//do:'     # prefix for the names that stand for a directory's .do files
 STAMP_DIR='dir'     # the stamp of a directory; mtime is unhelpful
 STAMP_MISSING='0'   # the stamp of a nonexistent file
 
 
 def _connect(dbfile):
-    _db = sqlite3.connect(dbfile, timeout=TIMEOUT)
+    # every File() does the same handful of queries over and over, so keep
+    # plenty of them compiled.
+    _db = sqlite3.connect(dbfile, timeout=TIMEOUT, cached_statements=256)
     _db.execute("pragma synchronous = off")
-    _db.execute("pragma journal_mode = PERSIST")
+    # In WAL mode, readers (like redo-ood, or a sub-redo checking whether
+    # its targets are dirty) don't wait for writers, and writers only wait
+    # for each other, not for readers.  It doesn't work on network
+    # filesystems, though, so REDO_DB_JOURNAL=persist goes back to the old
+    # way.  The mode is stored in the database, so only change it if we
+    # have to; changing it needs everyone else to stay out for a moment.
+    mode = vars.DB_JOURNAL.lower()
+    if _db.execute("pragma journal_mode").fetchone()[0].lower() != mode:
+        _db.execute("pragma journal_mode = %s" % mode)
+    _db.execute("pragma mmap_size = %d" % vars.DB_MMAP_SIZE)
+    if vars.DB_CACHE_SIZE:
+        _db.execute("pragma cache_size = %d" % -vars.DB_CACHE_SIZE)
     _db.text_factory = str
     return _db
 
 
+def _zap_old_locks(dbdir):
+    for name in glob.glob('%s/lock.*' % dbdir):
+        unlink(name)
+
+
+def _create_history(_db):
+    # one row for each time we ran a .do file: when it started, how long it
+    # took, and how much cpu (seconds) and memory (kbytes) it used.  The
+    # numbers include anything the .do ran, like sub-redos.  wait is how
+    # long it sat waiting for a jobserver token before it could start.
+    _db.execute("create table History "
+                "    (file int, "
+                "     runid int, "
+                "     start real, "
+                "     wall real, "
+                "     utime real, "
+                "     stime real, "
+                "     maxrss int, "
+                "     wait real, "
+                "     primary key (file,runid))")
+
+
 _db = None
+_log = None  # our depslog.DepsLog, if we're using that instead of sqlite
 def db():
-    global _db
+    global _db, _log, sqlite3
     if _db:
         return _db
         
@@ -35,6 +74,21 @@ def db():
         else:
             raise
 
+    # vars_init decided which one we're using: sqlite, unless the project
+    # already has a deps.log (or REDO_DB_BACKEND=log asked for one).
+    backend = vars.DB_BACKEND or 'sqlite'
+    if backend == 'log':
+        import depslog
+        _db = _log = depslog.DepsLog('%s/deps.log' % dbdir)
+        if not vars.RUNID:
+            vars.RUNID = _log.new_runid()
+            os.environ['REDO_RUNID'] = str(vars.RUNID)
+        return _db
+    elif backend != 'sqlite':
+        err('REDO_DB_BACKEND: %r should be sqlite or log\n' % backend)
+        sys.exit(1)
+    import sqlite3  # not until now, so the log doesn't have to pay for it
+
     must_create = not os.path.exists(dbfile)
     if not must_create:
         _db = _connect(dbfile)
@@ -42,7 +96,27 @@ def db():
             row = _db.cursor().execute("select version from Schema").fetchone()
         except sqlite3.OperationalError:
             row = None
-        ver = row and row[0] or None
+        ver = oldver = row and row[0] or None
+        # v2-v6 only added things; no need to throw everything away.
+        if ver == 1:
+            _db.execute("create index Deps_source on Deps (source)")
+            ver = 2
+        if ver == 2:
+            _db.execute("alter table Files add column hash")
+            ver = 3
+        if ver == 3:
+            # v4 replaced the .redo/lock.N files with byte ranges in
+            # .redo/locks, so the old ones are just clutter now.
+            _zap_old_locks(dbdir)
+            ver = 4
+        if ver == 4:
+            _create_history(_db)
+            ver = 6  # it already has the v6 column
+        if ver == 5:
+            _db.execute("alter table History add column wait real")
+            ver = 6
+        if ver != oldver and ver == SCHEMA_VER:
+            _db.execute("update Schema set version=?", [SCHEMA_VER])
         if ver != SCHEMA_VER:
             err("state database: discarding v%s (wanted v%s)\n"
                 % (ver, SCHEMA_VER))
@@ -50,6 +124,9 @@ def db():
             _db = None
     if must_create:
         unlink(dbfile)
+        unlink(dbfile + '-wal')  # or sqlite would "recover" from it
+        unlink(dbfile + '-shm')
+        _zap_old_locks(dbdir)
         _db = _connect(dbfile)
         _db.execute("create table Schema "
                     "    (version int)")
@@ -63,13 +140,16 @@ def db():
                     "     changed_runid int, "
                     "     failed_runid int, "
                     "     stamp, "
-                    "     csum)")
+                    "     csum, "
+                    "     hash)")
         _db.execute("create table Deps "
                     "    (target int, "
                     "     source int, "
                     "     mode not null, "
                     "     delete_me int, "
                     "     primary key (target,source))")
+        _db.execute("create index Deps_source on Deps (source)")
+        _create_history(_db)
         _db.execute("insert into Schema (version) values (?)", [SCHEMA_VER])
         # eat the '0' runid and File id
         _db.execute("insert into Runid values "
@@ -90,22 +170,205 @@ def init():
     db()
 
 
+# how long we spent writing to the database, including waiting for other
+# processes to finish writing.
+write_time = 0.0
+
 _wrote = 0
 def _write(q, l):
     if _insane:
         return
-    global _wrote
+    global _wrote, write_time
     _wrote += 1
+    start = time.time()
     db().execute(q, l)
+    write_time += time.time() - start
+
+
+def _write_many(q, ll):
+    if _insane or not ll:
+        return
+    global _wrote, write_time
+    _wrote += len(ll)
+    start = time.time()
+    db().executemany(q, ll)
+    write_time += time.time() - start
+
+
+# A .do script can run redo-ifchange (and friends) dozens of times, and
+# each one used to take the database write lock just to add a few
+# dependencies to the target.  But nobody looks at that target until the
+# redo that's building it (and holding its lock) reads it back after the
+# .do script exits.  So instead, those changes go into a journal file
+# ($REDO_JOURNAL) that the builder applies, all at once, in the same
+# transaction as the rest of its bookkeeping.  The same goes for noting
+# that we checked a file during this run, which only saves others some
+# work.  Anything else (eg. building a target, which other redos have to
+# see as soon as we unlock it) still goes straight to the database.
+_journal = []
+def _defer(q, l):
+    if vars.JOURNAL:
+        _journal.append((0, q, l))
+    else:
+        _write(q, l)
+
+
+def _defer_many(q, ll):
+    if not ll:
+        return
+    if vars.JOURNAL:
+        _journal.append((1, q, ll))
+    else:
+        _write_many(q, ll)
+
+
+def _flush_journal():
+    data = marshal.dumps(_journal)
+    del _journal[:]
+    # O_APPEND, and all in one write(), so that other processes of the same
+    # .do script can add theirs at the same time.
+    fd = os.open(vars.JOURNAL, os.O_WRONLY|os.O_APPEND|os.O_CREAT, 0666)
+    try:
+        os.write(fd, data)
+    finally:
+        os.close(fd)
 
 
-def commit():
+def apply_journal(path):
+    """Apply the changes our children left in journal file path."""
+    try:
+        f = open(path, 'rb')
+    except IOError, e:
+        if e.errno == errno.ENOENT:
+            return  # nobody wrote anything
+        raise
+    try:
+        while 1:
+            try:
+                l = marshal.load(f)
+            except EOFError:
+                break
+            if l:
+                _changing()
+            for many,q,args in l:
+                if many:
+                    _write_many(q, args)
+                else:
+                    _write(q, args)
+    finally:
+        f.close()
+        unlink(path)
+
+
+# Checking a big tree marks thousands of files as checked, and writing
+# each one to the database right away made a no-op build mostly a matter of
+# database updates.  Instead, we remember them here (file id -> runid) and
+# write them all at once when we commit, which is also when any other redo
+# (including the ones we run) would get to see them.  Until then, File
+# objects we load pick them up from here.
+_checked = {}
+def _flush_checked(before_job):
+    l = _checked.items()
+    _checked.clear()
+    l.sort()
+    if _log:
+        for id,runid in l:
+            _log.set_checked(id, runid)
+        return
+    # only ever move it forward, since by the time our journal gets
+    # applied, someone else might have rebuilt (and checked) the file.
+    q = ('update Files set checked_runid=? '
+         '  where rowid=? and (checked_runid is null or checked_runid<?)')
+    ll = [(runid, id, runid) for id,runid in l]
+    if before_job:
+        # the job's sub-redos are about to check most of the same files
+        # again, so they shouldn't have to wait for our journal.
+        _write_many(q, ll)
+    else:
+        _defer_many(q, ll)
+
+
+# The snapshot (see snapshot.py) only knows about file stamps, so anything
+# that could make a target dirty without touching a file (a new stamp, a
+# failure, different dependencies) throws it away as soon as it's committed,
+# no matter who did it or from where.
+SNAPSHOT = '.redo/snapshot'
+_changed = 0
+def _changing():
+    global _changed
+    _changed = 1
+
+
+def commit(before_job=False):
+    """Write out everything we've changed so far.
+
+    Pass before_job=True if we're about to start a job, so that it gets to
+    see what we've already checked, too.
+    """
     if _insane:
         return
-    global _wrote
-    if _wrote:
-        db().commit()
-        _wrote = 0
+    global _wrote, _changed, write_time
+    if _checked:
+        _flush_checked(before_job)
+    if _log:
+        start = time.time()
+        _log.commit()
+        write_time += time.time() - start
+    else:
+        if _journal:
+            _flush_journal()
+        if _wrote:
+            start = time.time()
+            db().commit()
+            write_time += time.time() - start
+            _wrote = 0
+    if _changed:
+        # only now, so a snapshot taken in the meantime doesn't survive it;
+        # see snapshot.save().
+        _changed = 0
+        unlink(os.path.join(vars.BASE, SNAPSHOT))
+
+
+def version():
+    """Return something that changes whenever someone else commits."""
+    if _log:
+        return _log.version()
+    row = db().execute('pragma data_version').fetchone()
+    return row and row[0]
+
+
+def _zap_dead_journals():
+    # A redo that got killed before it could apply its journal leaves it
+    # behind, and nobody else will ever want it.
+    for path in glob.glob('%s/.redo/journal.*.*' % vars.BASE):
+        pid = atoi(path.split('.')[-2])
+        try:
+            os.kill(pid, 0)
+        except OSError, e:
+            if e.errno == errno.ESRCH:
+                unlink(path)
+
+
+def checkpoint():
+    """Copy the write-ahead log back into the database and empty it.
+
+    sqlite does this on its own once the log gets big, but between builds,
+    nobody needs it, and it just makes the next build's readers look at
+    both.  (With REDO_DB_BACKEND=log, compact the log instead.)  Also
+    cleans up after any redo that died before it could apply its journal.
+    """
+    commit()
+    if _insane:
+        return
+    _zap_dead_journals()
+    if _log:
+        return _log.tidy()
+    if vars.DB_JOURNAL.lower() != 'wal':
+        return
+    try:
+        db().execute("pragma wal_checkpoint(TRUNCATE)")
+    except sqlite3.OperationalError:
+        pass  # someone else is still busy; they can do it later
 
 
 _insane = None
@@ -136,30 +399,353 @@ def relpath(t, base):
     return join('/', tparts)
 
 
+# os.stat() results, cached for the life of this process and keyed by path.
+# A no-op build looks at the same shared files (eg. popular .h files, or
+# the default*.do candidates of a busy directory) over and over, and on a
+# network filesystem each of those stats is a round trip.  Anyone who changes
+# a file, or gives another process a chance to change it (eg. by waiting for
+# a child job or a lock), has to call forget_stat() afterwards.
+_stats = {}
+stat_hits = 0
+stat_misses = 0
+def cached_stat(path):
+    """Like os.stat(), but cached, and returns None if path doesn't exist."""
+    global stat_hits, stat_misses
+    if path in _stats:
+        stat_hits += 1
+        return _stats[path]
+    stat_misses += 1
+    try:
+        st = os.stat(path)
+    except OSError:
+        st = None
+    _stats[path] = st
+    return st
+
+
+# On a slow (eg. network) filesystem, checking a big dependency tree is
+# mostly waiting for stat() round trips, one after another.  With
+# --stat-threads, isdirty() hands us all the children of each node before
+# looking at any of them; we stat them a few at a time in some helper
+# threads, and put the answers in the cache where read_stamp() will find
+# them.
+_stat_queue = None
+_stat_threads = []
+def _stat_worker(q):
+    while 1:
+        item = q.get()
+        if not item:
+            return
+        (path, done) = item
+        try:
+            st = os.stat(path)
+        except OSError:
+            st = None
+        done.put((path, st))
+
+
+def _stop_stat_threads():
+    # otherwise python 2 complains about them while shutting down
+    for t in _stat_threads:
+        _stat_queue.put(None)
+    for t in _stat_threads:
+        t.join()
+
+
+def prefetch_stats(paths):
+    """Put all of paths in the stat cache, stat()ing several at once."""
+    global _stat_queue, stat_misses
+    paths = [p for p in paths if p not in _stats]
+    if len(paths) < 2 or vars.STAT_THREADS < 1:
+        return  # nothing to gain
+    import Queue
+    if not _stat_queue:
+        import threading, atexit
+        _stat_queue = Queue.Queue()
+        for i in range(vars.STAT_THREADS):
+            t = threading.Thread(target=_stat_worker, args=(_stat_queue,))
+            t.setDaemon(True)
+            t.start()
+            _stat_threads.append(t)
+        atexit.register(_stop_stat_threads)
+    done = Queue.Queue()
+    for p in paths:
+        _stat_queue.put((p, done))
+    for i in range(len(paths)):
+        (p, st) = done.get()
+        _stats[p] = st
+    stat_misses += len(paths)
+
+
+def exists(path):
+    return cached_stat(path) != None
+
+
+# deps.isdirty() results, {file id: {max_changed: result}}, so that a
+# subtree shared by lots of targets gets walked only once, even if it's
+# dirty (checked_runid only saves us the trouble for clean ones).  They're
+# only as good as the stats they came from, so forget_stat() forgets them,
+# too: all of them, or the ones that depended on the path it forgets.
+dirty_memo = {}
+_memo_ids = {}    # name -> file id, for everything the results looked at
+_memo_users = {}  # file id -> {id of a result that looked at it: 1}
+
+
+def remember_dirty(f, max_changed, dirty, children):
+    """Save deps.isdirty()'s result for f, which looked at children."""
+    dirty_memo.setdefault(f.id, {})[max_changed] = dirty
+    _memo_ids[f.name] = f.id
+    for mode,f2 in children:
+        _memo_ids[f2.name] = f2.id
+        _memo_users.setdefault(f2.id, {})[f.id] = 1
+
+
+def _forget_dirty(fid):
+    todo = [fid]
+    while todo:
+        fid = todo.pop()
+        dirty_memo.pop(fid, None)
+        todo += _memo_users.pop(fid, {}).keys()
+
+
+def forget_stat(path=None):
+    """Drop path (or, if path is None, everything) from the stat cache.
+
+    Whatever deps_graph() has loaded about it goes, too.
+    """
+    if vars.WATCH:
+        watch.forget(path and relpath(path, vars.BASE))
+    if path == None:
+        dirty_memo.clear()
+        _memo_ids.clear()
+        _memo_users.clear()
+        _stats.clear()
+        _graph.clear()
+        _graph_files.clear()
+        _graph_names.clear()
+        _graph_stale.clear()
+    else:
+        name = relpath(path, vars.BASE)
+        _stats.pop(path, None)
+        if name in _memo_ids:
+            _forget_dirty(_memo_ids[name])
+        f = _graph_names.get(name)
+        if f:
+            # its deps might be different now, and everyone who depends on
+            # it needs its new stamp and runids, but we can't read those
+            # until whoever is changing it has saved them.
+            _graph.pop(f.id, None)
+            _graph_stale[f.id] = f
+
+
+# When redo looks for the .do file for a target, it has to remember all the
+# candidates that *didn't* exist, because if one of those appears later,
+# the target needs to be rebuilt with it.  Rather than a 'c' dependency on
+# each one (a dozen or more for every target, checked one by one for every
+# target), we make each directory we looked in a dependency, as a special
+# file whose stamp is the list of .do files in that directory.  All the
+# targets in a directory share those, so checking them is one listdir()
+# per directory.  .do files can't be generated during the build, so we
+# only have to list each directory once per run.
+_dolists = {}
+def dofiles(d):
+    """Return the names of the .do files in directory d, as a dict."""
+    names = _dolists.get(d)
+    if names == None:
+        names = _dolists[d] = {}
+        try:
+            for n in os.listdir(d):
+                if n.endswith('.do'):
+                    names[n] = 1
+        except OSError:
+            pass  # doesn't exist, isn't a directory, or we can't read it
+    return names
+
+
+def dofiles_name(d):
+    """Return the name of the special file for the .do files in d."""
+    return DOFILES + relpath(d, vars.BASE)
+
+
+def _fixname(name):
+    if name.startswith('//'):
+        return name  # special name, not relative to anything
+    return relpath(name, vars.BASE)
+
+
+def add_history(fid, start, wall, utime, stime, maxrss, wait):
+    if _log:
+        return _log.add_history(fid, vars.RUNID, start, wall,
+                                utime, stime, maxrss, wait)
+    _write("insert or replace into History "
+           "    (file, runid, start, wall, utime, stime, maxrss, wait) "
+           "    values (?,?,?,?,?,?,?,?)",
+           [fid, vars.RUNID, start, wall, utime, stime, maxrss, wait])
+
+
+def history(runid=None):
+    """Return (runid, {id: (start, wall, utime, stime, maxrss, wait)}).
+
+    If runid is None, use the most recent run that built anything.
+    """
+    d = db()
+    if _log:
+        return _log.history(runid)
+    if runid == None:
+        runid = d.execute("select max(runid) from History").fetchone()[0]
+    h = {}
+    for row in d.execute("select file, start, wall, utime, stime, maxrss, "
+                         "    wait from History where runid=?", [runid]):
+        h[row[0]] = row[1:]
+    return runid, h
+
+
+def own_time(start, wall, deps):
+    """Return how much of a build's wall time wasn't spent on its deps.
+
+    The build started at start and took wall seconds; deps is a list of
+    (start, wall) for the dependencies that got built meanwhile.
+    """
+    spans = []
+    for (dstart, dwall) in deps:
+        s = max(dstart, start)
+        e = min(dstart + dwall, start + wall)
+        if e > s:
+            spans.append((s, e))
+    # sub-builds can run in parallel, so don't count any moment twice.
+    spans.sort()
+    busy = 0
+    end = start
+    for s,e in spans:
+        s = max(s, end)
+        if e > s:
+            busy += e - s
+            end = e
+    return max(wall - busy, 0)
+
+
+def critical_times(fl):
+    """Guess how long it'll take to build each of the Files in fl.
+
+    Returns {file id: seconds}, where the guess for a target is the
+    longest chain of targets beneath it (including itself), going by how
+    long each one took the last time we built it.  Targets we've never
+    built are left out.
+    """
+    graph = deps_graph(fl)
+    ids = {}
+    for f in fl:
+        ids[f.id] = 1
+    for l in graph.values():
+        for mode,f2 in l:
+            ids[f2.id] = 1
+    ids = ids.keys()
+    last = {}
+    d = db()
+    if _log:
+        last = _log.last_history(ids)
+        ids = []
+    for i in range(0, len(ids), 500):
+        chunk = ids[i:i+500]
+        q = ('select file, max(runid), start, wall from History '
+             '  where file in (%s) group by file'
+             % join(',', ['?'] * len(chunk)))
+        for (fid, runid, start, wall) in d.execute(q, chunk):
+            last[fid] = (runid, start, wall)
+
+    # A target's wall time includes building (or waiting for) any of its
+    # dependencies that got built in the same run, so take those out.
+    def self_time(t):
+        (runid, start, wall) = last[t]
+        deps = []
+        for mode,f2 in graph.get(t, []):
+            dl = last.get(f2.id)
+            if mode == 'm' and dl and dl[0] == runid and f2.id != t:
+                deps.append(dl[1:])
+        return own_time(start, wall, deps)
+
+    def subs(t):
+        return [f2.id for (mode,f2) in graph.get(t, [])
+                if mode == 'm' and f2.id in last]
+
+    # Dependency chains can be longer than python's recursion limit, so
+    # walk them with our own stack.  A target's time is None while we're
+    # still working on the ones beneath it (so a cycle counts as 0).
+    times = {}
+    out = {}
+    for f in fl:
+        if f.id not in last:
+            continue
+        stack = [f.id]
+        while stack:
+            t = stack[-1]
+            if t not in times:
+                times[t] = None
+                stack += [t2 for t2 in subs(t) if t2 not in times]
+                continue
+            stack.pop()
+            if times[t] == None:
+                sub = 0
+                for t2 in subs(t):
+                    sub = max(sub, times[t2] or 0)
+                times[t] = self_time(t) + sub
+        out[f.id] = times[f.id]
+    return out
+
+
 def warn_override(name):
     warn('%s - you modified it; skipping\n' % name)
 
 
+def read_stamp(name):
+    """Return the current stamp of the file called name in the database."""
+    if name.startswith(DOFILES):
+        l = dofiles(os.path.join(vars.BASE, name[len(DOFILES):])).keys()
+        l.sort()
+        return 'do:' + join('/', l)
+    st = cached_stat(os.path.join(vars.BASE, name))
+    if not st:
+        return STAMP_MISSING
+    if stat.S_ISDIR(st.st_mode):
+        return STAMP_DIR
+    else:
+        # a "unique identifier" stamp for a regular file
+        return str((st.st_ctime, st.st_mtime, st.st_size, st.st_ino))
+
+
 _file_cols = ['rowid', 'name', 'is_generated', 'is_override',
               'checked_runid', 'changed_runid', 'failed_runid',
-              'stamp', 'csum']
+              'stamp', 'csum', 'hash']
+_q_by_id = 'select %s from Files where rowid=?' % join(', ', _file_cols)
+_q_by_name = 'select %s from Files where name=?' % join(', ', _file_cols)
+_q_save = ('update Files set %s where rowid=?'
+           % join(', ', ['%s=?' % i for i in _file_cols[2:]]))
+_q_deps = ('select Deps.mode, Deps.source, %s '
+           '  from Files '
+           '    join Deps on Files.rowid = Deps.source '
+           '  where target=?' % join(', ', _file_cols[1:]))
 class File(object):
     # use this mostly to avoid accidentally assigning to typos
-    __slots__ = ['id'] + _file_cols[1:]
+    __slots__ = ['id', 'defer'] + _file_cols[1:]
 
     def _init_from_idname(self, id, name):
-        q = ('select %s from Files ' % join(', ', _file_cols))
         if id != None:
-            q += 'where rowid=?'
+            q = _q_by_id
             l = [id]
         elif name != None:
-            name = (name==ALWAYS) and ALWAYS or relpath(name, vars.BASE)
-            q += 'where name=?'
+            name = _fixname(name)
+            q = _q_by_name
             l = [name]
         else:
             raise Exception('name or id must be set')
         d = db()
-        row = d.execute(q, l).fetchone()
+        if _log:
+            row = _log.file(id, name)
+            if not row and name:
+                _log.intern([name])
+                row = _log.file(id, name)
+        else:
+            row = d.execute(q, l).fetchone()
         if not row:
             if not name:
                 raise Exception('File with id=%r not found and '
@@ -177,11 +763,15 @@ class File(object):
     def _init_from_cols(self, cols):
         (self.id, self.name, self.is_generated, self.is_override,
          self.checked_runid, self.changed_runid, self.failed_runid,
-         self.stamp, self.csum) = cols
+         self.stamp, self.csum, self.hash) = cols
+        if self.id in _checked and self.checked_runid < _checked[self.id]:
+            self.checked_runid = _checked[self.id]
         if self.name == ALWAYS and self.changed_runid < vars.RUNID:
             self.changed_runid = vars.RUNID
     
     def __init__(self, id=None, name=None, cols=None):
+        # set this for the target whose .do script ran us; see _defer()
+        self.defer = False
         if cols:
             return self._init_from_cols(cols)
         else:
@@ -191,13 +781,17 @@ class File(object):
         self._init_from_idname(self.id, None)
 
     def save(self):
-        cols = join(', ', ['%s=?'%i for i in _file_cols[2:]])
-        _write('update Files set '
-               '    %s '
-               '    where rowid=?' % cols,
+        _changing()
+        if _log:
+            return _log.save(self.id,
+                             [self.is_generated, self.is_override,
+                              self.checked_runid, self.changed_runid,
+                              self.failed_runid,
+                              self.stamp, self.csum, self.hash])
+        (self.defer and _defer or _write)(_q_save,
                [self.is_generated, self.is_override,
                 self.checked_runid, self.changed_runid, self.failed_runid,
-                self.stamp, self.csum,
+                self.stamp, self.csum, self.hash,
                 self.id])
 
     def set_checked(self):
@@ -205,7 +799,7 @@ class File(object):
 
     def set_checked_save(self):
         self.set_checked()
-        self.save()
+        _checked[self.id] = self.checked_runid  # see _flush_checked()
 
     def set_changed(self):
         debug2('BUILT: %r (%r)\n' % (self.name, self.stamp))
@@ -220,9 +814,11 @@ class File(object):
         self.is_generated = True
 
     def set_static(self):
+        if self.is_generated:
+            self.hash = None  # if any, it's from before we were generated
+        self.is_generated = False
         self.update_stamp(must_exist=True)
         self.is_override = False
-        self.is_generated = False
 
     def set_override(self):
         self.update_stamp()
@@ -234,8 +830,13 @@ class File(object):
             raise Exception("%r does not exist" % self.name)
         if newstamp != self.stamp:
             debug2("STAMP: %s: %r -> %r\n" % (self.name, self.stamp, newstamp))
+            oldhash = self.hash
+            self.hash = None
+            if self._hashable(newstamp):
+                self.hash = self.read_hash()
             self.stamp = newstamp
-            self.set_changed()
+            if not oldhash or self.hash != oldhash:
+                self.set_changed()
 
     def is_checked(self):
         return self.checked_runid and self.checked_runid >= vars.RUNID
@@ -247,11 +848,12 @@ class File(object):
         return self.failed_runid and self.failed_runid >= vars.RUNID
 
     def deps(self):
-        q = ('select Deps.mode, Deps.source, %s '
-             '  from Files '
-             '    join Deps on Files.rowid = Deps.source '
-             '  where target=?' % join(', ', _file_cols[1:]))
-        for row in db().execute(q, [self.id]).fetchall():
+        if _log:
+            rows = [(mode,) + cols
+                    for (t, mode, cols) in _log.deps_of([self.id])]
+        else:
+            rows = db().execute(_q_deps, [self.id]).fetchall()
+        for row in rows:
             mode = row[0]
             cols = row[1:]
             assert(mode in ('c', 'm'))
@@ -259,54 +861,284 @@ class File(object):
 
     def zap_deps1(self):
         debug2('zap-deps1: %r\n' % self.name)
+        _changing()
+        if _log:
+            return _log.zap_deps1(self.id)
         _write('update Deps set delete_me=? where target=?', [True, self.id])
 
     def zap_deps2(self):
         debug2('zap-deps2: %r\n' % self.name)
+        _changing()
+        if _log:
+            return _log.zap_deps2(self.id)
         _write('delete from Deps where target=? and delete_me=1', [self.id])
 
     def add_dep(self, mode, dep):
-        src = File(name=dep)
-        debug3('add-dep: "%s" < %s "%s"\n' % (self.name, mode, src.name))
-        assert(self.id != src.id)
-        _write("insert or replace into Deps "
-               "    (target, mode, source, delete_me) values (?,?,?,?)",
-               [self.id, mode, src.id, False])
+        self.add_deps(mode, [dep])
+
+    def add_deps(self, mode, deps):
+        names = [_fixname(dep) for dep in deps]
+        ids = _file_ids(names)
+        l = []
+        for name in names:
+            debug3('add-dep: "%s" < %s "%s"\n' % (self.name, mode, name))
+            assert(self.id != ids[name])
+            l.append([self.id, mode, ids[name], False])
+        _changing()
+        if _log:
+            return _log.add_deps(self.id, mode, [ids[name] for name in names])
+        (self.defer and _defer_many or _write_many)(
+                    "insert or replace into Deps "
+                    "    (target, mode, source, delete_me) values (?,?,?,?)",
+                    l)
 
     def read_stamp(self):
+        return read_stamp(self.name)
+
+    def _hashable(self, stamp):
+        return (vars.CONTENT_STAMPS and not self.is_generated
+                and not self.name.startswith('//')
+                and stamp != STAMP_MISSING and stamp != STAMP_DIR)
+
+    def read_hash(self):
+        """Return the sha1 of the file's contents, or None if it's gone."""
         try:
-            st = os.stat(os.path.join(vars.BASE, self.name))
-        except OSError:
-            return STAMP_MISSING
-        if stat.S_ISDIR(st.st_mode):
-            return STAMP_DIR
+            import hashlib
+        except ImportError:
+            import sha  # python 2.4; see redo-stamp.py
+            sh = sha.sha()
         else:
-            # a "unique identifier" stamp for a regular file
-            return str((st.st_ctime, st.st_mtime, st.st_size, st.st_ino))
+            sh = hashlib.sha1()
+        try:
+            f = open(os.path.join(vars.BASE, self.name), 'rb')
+        except IOError:
+            return None
+        # don't read the whole thing into memory at once; source files can
+        # be big (eg. checked-in binaries).
+        while 1:
+            b = f.read(1024*1024)
+            if not b: break
+            sh.update(b)
+        f.close()
+        return sh.hexdigest()
+
+    def same_content(self, newstamp):
+        """True if only the metadata of this source file has changed.
+
+        With --content-stamps, we remember a hash of each source file's
+        contents along with its stamp, so a touch, a chmod, or a checkout
+        that rewrites the same bytes doesn't make everything that depends
+        on it dirty.  We only have to rehash when the stamp changes, so a
+        clean build costs no more than before.
+        """
+        if not self.hash or not self._hashable(newstamp):
+            return False
+        return self.read_hash() == self.hash
 
     def nicename(self):
         return relpath(os.path.join(vars.BASE, self.name), vars.STARTDIR)
 
 
+def _file_ids(names):
+    """Return a dict of {name: id}, adding any names not yet in Files."""
+    d = db()
+    if _log:
+        return _log.intern(names)
+    ids = {}
+    def lookup(names):
+        for i in range(0, len(names), 500):  # sqlite limits the ?s per query
+            chunk = names[i:i+500]
+            q = ('select rowid, name from Files where name in (%s)'
+                 % join(',', ['?'] * len(chunk)))
+            for id,name in d.execute(q, chunk).fetchall():
+                ids[name] = id
+    lookup(names)
+    missing = {}
+    for name in names:
+        if name not in ids:
+            missing[name] = 1
+    if missing:
+        # "or ignore" because some parallel redo might add the same names
+        # at the same time; no big deal.
+        _write_many('insert or ignore into Files (name) values (?)',
+                    [[name] for name in missing.keys()])
+        lookup(missing.keys())
+    return ids
+
+
 def files():
     q = ('select %s from Files order by name' % join(', ', _file_cols))
-    for cols in db().execute(q).fetchall():
+    d = db()
+    if _log:
+        rows = _log.files()
+    else:
+        rows = d.execute(q).fetchall()
+    for cols in rows:
         yield File(cols=cols)
 
 
+def last_runid():
+    """Return the newest runid anyone has started."""
+    d = db()
+    if _log:
+        return _log.last_runid()
+    return d.execute('select max(id) from Runid').fetchone()[0] or 0
+
+
+# The part of the dependency graph that deps.isdirty() has loaded so far,
+# kept for the life of the process so that targets which share a subtree
+# don't each load it all over again.  Like the stat cache, it's only good
+# until someone changes things: forget_stat(path) drops the deps of that
+# one file and has its File reread (in _graph_stale) the next time we
+# get here, and forget_stat() throws the whole thing away.
+_graph = {}
+_graph_files = {}  # file id -> File
+_graph_names = {}  # file name -> File
+_graph_stale = {}  # file id -> File
+
+
+def deps_graph(f=None, expand=None):
+    """Load the dependency graph reachable from File f into memory.
+
+    Returns a dict of {target id: [(mode, File), ...]}.  Each File object
+    appears only once, no matter how many targets depend on it, so once
+    it's marked as checked, everyone sees it.  f can also be a list of
+    Files.  If f is None, loads the whole graph.
+
+    Rather than running one query per target, as File.deps() does, we ask
+    for the deps of a whole batch of targets at a time.
+
+    If expand is given, then expand(parent, child) says whether we'll need
+    the deps of child (a File that parent depends on) too; the ones it
+    says no to aren't loaded.  In that case, the graph is the one kept in
+    _graph: parts of it that were loaded before aren't loaded again, and
+    every target whose deps we loaded is in it, even with no deps at all.
+    """
+    q = ('select Deps.target, Deps.mode, Deps.source, %s '
+         '  from Files '
+         '    join Deps on Files.rowid = Deps.source '
+         % join(', ', _file_cols[1:]))
+    d = db()
+    if expand:
+        graph = _graph
+        files = _graph_files
+        names = _graph_names
+        new = None
+        if vars.WATCH:
+            new = []  # for watch.prefetch()
+        for f1 in _graph_stale.values():
+            f1.refresh()
+        _graph_stale.clear()
+    else:
+        graph = {}
+        files = {}
+        names = {}
+        new = None
+    if f == None:
+        todo = queued = None
+        if _log:
+            rows = [(t, mode) + cols for (t, mode, cols) in _log.deps_of()]
+        else:
+            rows = d.execute(q).fetchall()
+    else:
+        if isinstance(f, File):
+            f = [f]
+        todo = []
+        queued = {}
+        for f1 in f:
+            if not queued.get(f1.id) and f1.id not in graph:
+                todo.append(f1.id)
+                queued[f1.id] = 1
+            if f1.id not in files:
+                files[f1.id] = names[f1.name] = f1
+        rows = []
+    while 1:
+        for row in rows:
+            target, mode, cols = row[0], row[1], row[2:]
+            assert(mode in ('c', 'm'))
+            f2 = files.get(cols[0])
+            if not f2:
+                f2 = files[cols[0]] = names[cols[1]] = File(cols=cols)
+                if new != None:
+                    new.append(f2.name)
+            if (mode == 'm' and todo != None and not queued.get(f2.id)
+                  and f2.id not in graph
+                  and (not expand or expand(files[target], f2))):
+                queued[f2.id] = 1
+                todo.append(f2.id)
+            graph.setdefault(target, []).append((mode, f2))
+        if not todo:
+            break
+        ids = todo[:500]  # sqlite limits the number of ?s in a query
+        del todo[:500]
+        for id in ids:
+            graph[id] = []
+        if _log:
+            rows = [(t, mode) + cols for (t, mode, cols) in _log.deps_of(ids)]
+            continue
+        rows = d.execute(q + 'where target in (%s)'
+                         % join(',', ['?'] * len(ids)), ids).fetchall()
+    if new:
+        watch.prefetch(new)
+    return graph
+
+
+def rdeps(fl):
+    """Return a list of all Files that depend on any of the Files in fl.
+
+    That includes Files that depend on them indirectly, ie. everything that
+    might need to be rebuilt if any of the Files in fl changed.
+    """
+    q = ('select distinct Deps.target, %s '
+         '  from Files '
+         '    join Deps on Files.rowid = Deps.target '
+         % join(', ', _file_cols[1:]))
+    d = db()
+    found = {}
+    todo = [f.id for f in fl]
+    while todo:
+        ids = todo[:500]  # sqlite limits the number of ?s in a query
+        del todo[:500]
+        if _log:
+            rows = [_log.file(id) for id in _log.users_of(ids)]
+        else:
+            rows = d.execute(q + 'where source in (%s)'
+                             % join(',', ['?'] * len(ids)), ids).fetchall()
+        for cols in rows:
+            if cols[0] not in found:
+                found[cols[0]] = File(cols=cols)
+                todo.append(cols[0])
+    return found.values()
+
+
 # FIXME: I really want to use fcntl F_SETLK, F_SETLKW, etc here.  But python
 # doesn't do the lockdata structure in a portable way, so we have to use
 # fcntl.lockf() instead.  Usually this is just a wrapper for fcntl, so it's
 # ok, but it doesn't have F_GETLK, so we can't report which pid owns the lock.
 # The makes debugging a bit harder.  When we someday port to C, we can do that.
+# Rather than one lock file per target, which leaves a .redo directory full
+# of them in a big project, we lock one byte per target (at offset = its
+# file id) in a single shared file.  lockf() locks belong to the process,
+# not the fd, and closing *any* fd for a file drops all our locks on it, so
+# we open it once and never close it.
 _locks = {}
+_lockfile = None
+def _lock_fd():
+    global _lockfile
+    if _lockfile == None:
+        _lockfile = os.open(os.path.join(vars.BASE, '.redo/locks'),
+                            os.O_RDWR | os.O_CREAT, 0666)
+        close_on_exec(_lockfile, True)
+    return _lockfile
+
+
 class Lock:
     def __init__(self, fid):
         self.owned = False
         self.fid = fid
-        self.lockfile = os.open(os.path.join(vars.BASE, '.redo/lock.%d' % fid),
-                                os.O_RDWR | os.O_CREAT, 0666)
-        close_on_exec(self.lockfile, True)
+        self.lockfile = _lock_fd()
+        # we'd never block on a lock we already hold ourselves, so we'd
+        # better not try.
         assert(_locks.get(fid,0) == 0)
         _locks[fid] = 1
 
@@ -314,12 +1146,12 @@ class Lock:
         _locks[self.fid] = 0
         if self.owned:
             self.unlock()
-        os.close(self.lockfile)
 
     def trylock(self):
         assert(not self.owned)
         try:
-            fcntl.lockf(self.lockfile, fcntl.LOCK_EX|fcntl.LOCK_NB, 0, 0)
+            fcntl.lockf(self.lockfile, fcntl.LOCK_EX|fcntl.LOCK_NB,
+                        1, self.fid)
         except IOError, e:
             if e.errno in (errno.EAGAIN, errno.EACCES):
                 pass  # someone else has it locked
@@ -330,12 +1162,111 @@ class Lock:
 
     def waitlock(self):
         assert(not self.owned)
-        fcntl.lockf(self.lockfile, fcntl.LOCK_EX, 0, 0)
+        fcntl.lockf(self.lockfile, fcntl.LOCK_EX, 1, self.fid)
         self.owned = True
             
     def unlock(self):
         if not self.owned:
             raise Exception("can't unlock %r - we don't own it" 
-                            % self.lockname)
-        fcntl.lockf(self.lockfile, fcntl.LOCK_UN, 0, 0)
+                            % self.fid)
+        fcntl.lockf(self.lockfile, fcntl.LOCK_UN, 1, self.fid)
         self.owned = False
+
+
+# Open file description locks (Linux 3.15 and up) belong to an open file,
+# not to the process, so a thread can take one without touching the locks
+# the rest of the process holds with lockf().  python 2's fcntl module
+# doesn't know about them, so we pack the struct flock ourselves.
+F_OFD_GETLK = 36
+F_OFD_SETLK = 37
+F_OFD_SETLKW = 38
+_ofd_file = None
+def _ofd_fd():
+    """Return our fd for OFD locks on .redo/locks, or None if we can't.
+
+    It has to be a separate open() from _lock_fd(), and like that one, we
+    never close it: that would drop all our lockf() locks.
+    """
+    global _ofd_file
+    if _ofd_file == None:
+        _ofd_file = -1
+        if sys.platform.startswith('linux'):
+            fd = os.open(os.path.join(vars.BASE, '.redo/locks'),
+                         os.O_RDWR | os.O_CREAT, 0666)
+            close_on_exec(fd, True)
+            try:
+                _ofd_lock(fd, F_OFD_GETLK, fcntl.F_WRLCK, 0)
+            except IOError, e:
+                if e.errno != errno.EINVAL:
+                    raise
+                os.close(fd)  # too old; we don't hold any locks with it
+            else:
+                _ofd_file = fd
+    if _ofd_file < 0:
+        return None
+    return _ofd_file
+
+
+def _ofd_lock(fd, cmd, type, fid):
+    import struct
+    fcntl.fcntl(fd, cmd, struct.pack('hhqqi', type, 0, fid, 1, 0))
+
+
+class LockWaiter:
+    """Find out when any of several locks gets released, all at once.
+
+    There's no way to wait for more than one lock at a time, so each one
+    gets a helper thread that blocks on it with an OFD lock, and lets it go
+    again as soon as it gets it.  Then it writes the file id to a pipe, so
+    the caller can wait for that along with everything else.  (Like after
+    Lock.waitlock(), someone else might grab the lock again before we try
+    for it ourselves; then just watch() it again.)
+
+    Without OFD locks, self.usable is false, and the caller has to go back
+    to waiting for one Lock at a time.
+    """
+    def __init__(self):
+        (self.fd, self.wfd) = os.pipe()
+        close_on_exec(self.fd, True)
+        close_on_exec(self.wfd, True)
+        self.waiting = {}
+        self.buf = ''
+        self.usable = _ofd_fd() != None
+
+    def _wait(self, fid):
+        fd = _ofd_fd()
+        while 1:
+            try:
+                _ofd_lock(fd, F_OFD_SETLKW, fcntl.F_WRLCK, fid)
+            except IOError, e:
+                if e.errno == errno.EINTR:
+                    continue
+                raise
+            break
+        _ofd_lock(fd, F_OFD_SETLK, fcntl.F_UNLCK, fid)
+        os.write(self.wfd, '%d\n' % fid)
+
+    def watch(self, fid):
+        """Start waiting for lock fid, unless we already are."""
+        if fid in self.waiting:
+            return
+        import threading
+        self.waiting[fid] = 1
+        t = threading.Thread(target=self._wait, args=(fid,))
+        t.setDaemon(True)  # in case we give up before it's done
+        t.start()
+
+    def freed(self):
+        """Return the ids of the locks that got released since last time.
+
+        Doesn't block; once there's anything to return, self.fd is readable.
+        """
+        import select
+        while select.select([self.fd], [], [], 0)[0]:
+            self.buf += os.read(self.fd, 4096)
+        lines = self.buf.split('\n')
+        self.buf = lines.pop()
+        fids = [int(i) for i in lines]
+        for fid in fids:
+            del self.waiting[fid]
+        return fids
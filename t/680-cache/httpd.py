@@ -0,0 +1,42 @@
+#!/usr/bin/env python
+#
+# A stand-in for a shared HTTP build cache: answers GET and PUT out of a
+# directory.  Once it's listening, it writes its port number to argv[2].
+#
+import sys, os, BaseHTTPServer
+
+root = sys.argv[1]
+
+
+class Handler(BaseHTTPServer.BaseHTTPRequestHandler):
+    def _path(self):
+        return os.path.join(root, self.path.strip('/').replace('/', '_'))
+
+    def do_GET(self):
+        try:
+            data = open(self._path(), 'rb').read()
+        except IOError:
+            self.send_error(404)
+            return
+        self.send_response(200)
+        self.send_header('Content-Length', str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+    def do_PUT(self):
+        n = int(self.headers.getheader('Content-Length') or 0)
+        f = open(self._path(), 'wb')
+        f.write(self.rfile.read(n))
+        f.close()
+        self.send_response(201)
+        self.send_header('Content-Length', '0')
+        self.end_headers()
+
+    def log_message(self, *args):
+        pass
+
+
+server = BaseHTTPServer.HTTPServer(('127.0.0.1', 0), Handler)
+open(sys.argv[2] + '.tmp', 'w').write('%d\n' % server.server_address[1])
+os.rename(sys.argv[2] + '.tmp', sys.argv[2])
+server.serve_forever()
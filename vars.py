@@ -18,6 +18,16 @@ VERBOSE = os.environ.get('REDO_VERBOSE', '') and 1 or 0
 XTRACE = os.environ.get('REDO_XTRACE', '') and 1 or 0
 KEEP_GOING = os.environ.get('REDO_KEEP_GOING', '') and 1 or 0
 SHUFFLE = os.environ.get('REDO_SHUFFLE', '') and 1 or 0
+STAT_THREADS = atoi(os.environ.get('REDO_STAT_THREADS', ''))
+CONTENT_STAMPS = os.environ.get('REDO_CONTENT_STAMPS', '') and 1 or 0
+WATCH = os.environ.get('REDO_WATCH', '') and 1 or 0
+CACHE = os.environ.get('REDO_CACHE', '')
+JOURNAL = os.environ.get('REDO_JOURNAL', '')
+DB_BACKEND = os.environ.get('REDO_DB_BACKEND', '')
+DB_JOURNAL = os.environ.get('REDO_DB_JOURNAL', '') or 'wal'
+DB_MMAP_SIZE = atoi(os.environ.get('REDO_DB_MMAP_SIZE', str(64*1024*1024)))
+DB_CACHE_SIZE = atoi(os.environ.get('REDO_DB_CACHE_SIZE', ''))  # kbytes
+CACHE_SIZE = os.environ.get('REDO_CACHE_SIZE', '')
 STARTDIR = os.environ.get('REDO_STARTDIR', '')
 RUNID = atoi(os.environ.get('REDO_RUNID')) or None
 BASE = os.environ['REDO_BASE']
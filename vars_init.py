@@ -1,7 +1,14 @@
 import sys, os
 
-def init(targets):
-    if not os.environ.get('REDO'):
+def init(targets, check_snapshot=False):
+    """Set up redo's environment.
+
+    With check_snapshot, if this is a toplevel redo and snapshot.unchanged()
+    says targets are up to date, return True right away, before we even
+    open the database.
+    """
+    toplevel = not os.environ.get('REDO')
+    if toplevel:
         # toplevel call to redo
         if len(targets) == 0:
             targets.append('all')
@@ -31,6 +38,26 @@ def init(targets):
                 break
         os.environ['REDO_BASE'] = base
         os.environ['REDO_STARTDIR'] = os.getcwd()
+        init_db = True
+    else:
+        init_db = False
+
+    if 'REDO_WATCH' not in os.environ:
+        # look for redo-watch just once, here, instead of having every
+        # redo-ifchange try to connect to it; see watch.py.
+        sock = os.environ['REDO_BASE'] + '/.redo/watch.sock'
+        os.environ['REDO_WATCH'] = os.path.exists(sock) and '1' or ''
+
+    if not os.environ.get('REDO_DB_BACKEND'):
+        # likewise, only the first redo looks for a deps.log; see state.db().
+        log = os.environ['REDO_BASE'] + '/.redo/deps.log'
+        os.environ['REDO_DB_BACKEND'] = (os.path.exists(log) and 'log'
+                                         or 'sqlite')
 
+    if check_snapshot and toplevel:
+        import snapshot
+        if snapshot.unchanged(targets):
+            return True
+    if init_db:
         import state
         state.init()
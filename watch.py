@@ -0,0 +1,299 @@
+#
+# Talking to redo-watch, a daemon that uses inotify to keep track of which
+# files have changed, so that redo doesn't have to stat() every single
+# source file on every run just to find out that nothing happened.
+#
+# The daemon watches the directory of every file redo knows about (and all
+# of its parents, so it notices when a whole directory gets renamed away).
+# For each file it can tell us a runid: if we checked the file's stamp
+# during that run or a later one, then the file hasn't changed since, and
+# the stamp in the database is still right.  It works like this:
+#
+#  - when the daemon starts watching a directory, it notes the newest runid
+#    in the database *after* adding the watch.  Any run newer than that
+#    started after the watch was in place, so the daemon would have seen
+#    any changes since.
+#
+#  - when the daemon sees an event for a file, it notes the newest runid
+#    *after* reading the event.  Any run newer than that started after the
+#    change, so whatever redo saw then already included it.
+#
+# The answer for a file is one more than the larger of those two runids,
+# or 0 if the daemon isn't watching the directory at all (eg. because it
+# ran out of inotify watches).  Before answering, the daemon reads all the
+# events that are waiting for it, so anything that happened before we
+# asked is accounted for.
+#
+# If there is no daemon, we just stat() everything like we always did.
+# Almost nobody runs one, so only the toplevel redo looks for its socket,
+# and tells the rest of the build in $REDO_WATCH; without that, nobody
+# even imports this module.
+#
+import sys, os, errno
+import vars
+
+_absent = 0
+_since = {}
+
+
+def _path():
+    return '%s/.redo/watch.sock' % vars.BASE
+
+
+def _ask(names):
+    global _absent
+    # the socket module drags in the ssl module (and so on), which costs
+    # more than everything else we do here put together, so use _socket.
+    import _socket
+    s = _socket.socket(_socket.AF_UNIX, _socket.SOCK_STREAM)
+    try:
+        try:
+            s.connect(_path())
+            s.sendall(''.join([n + '\n' for n in names]))
+            s.shutdown(_socket.SHUT_WR)
+            resp = []
+            while 1:
+                b = s.recv(65536)
+                if not b: break
+                resp.append(b)
+        except _socket.error:
+            _absent = 1  # no daemon; don't bother asking again
+            return
+    finally:
+        s.close()
+    vals = ''.join(resp).split('\n')[:-1]
+    if len(vals) != len(names):
+        _absent = 1  # daemon died halfway through?
+        return
+    for n,v in zip(names, vals):
+        _since[n] = int(v)
+
+
+def prefetch(names):
+    """Ask the daemon about all the given names at once."""
+    if _absent:
+        return
+    names = [n for n in names
+             if n not in _since and not n.startswith('//')]
+    if names:
+        _ask(names)
+
+
+def unchanged_since(name, runid):
+    """True if the daemon promises name hasn't changed since run runid.
+
+    name is relative to vars.BASE, like in the Files table.
+    """
+    if _absent or not runid or name.startswith('//'):
+        return False
+    if name not in _since:
+        _ask([name])
+    v = _since.get(name)
+    return v and runid >= v
+
+
+def forget(name=None):
+    """Drop what the daemon told us about name (or, if None, everything).
+
+    The daemon's promises are only good as of the time we asked, so like
+    the stat cache in state.py, we have to forget them once anyone else
+    has had a chance to change things.
+    """
+    if name == None:
+        _since.clear()
+    else:
+        _since.pop(name, None)
+
+
+IN_MODIFY      = 0x00000002
+IN_ATTRIB      = 0x00000004
+IN_CLOSE_WRITE = 0x00000008
+IN_MOVED_FROM  = 0x00000040
+IN_MOVED_TO    = 0x00000080
+IN_CREATE      = 0x00000100
+IN_DELETE      = 0x00000200
+IN_DELETE_SELF = 0x00000400
+IN_MOVE_SELF   = 0x00000800
+IN_Q_OVERFLOW  = 0x00004000
+IN_IGNORED     = 0x00008000
+IN_ONLYDIR     = 0x01000000
+_MASK = (IN_MODIFY | IN_ATTRIB | IN_CLOSE_WRITE | IN_MOVED_FROM |
+         IN_MOVED_TO | IN_CREATE | IN_DELETE | IN_DELETE_SELF |
+         IN_MOVE_SELF | IN_ONLYDIR)
+
+
+class Watcher:
+    def __init__(self):
+        import ctypes, ctypes.util, fcntl
+        self.libc = ctypes.CDLL(ctypes.util.find_library('c'), use_errno=True)
+        self.fd = self.libc.inotify_init()
+        if self.fd < 0:
+            e = ctypes.get_errno()
+            raise OSError(e, os.strerror(e))
+        fl = fcntl.fcntl(self.fd, fcntl.F_GETFL)
+        fcntl.fcntl(self.fd, fcntl.F_SETFL, fl | os.O_NONBLOCK)
+        self.wds = {}       # wd -> absolute directory name
+        self.dirs = {}      # absolute directory name -> [wd, runid]
+        self.changed = {}   # absolute file name -> runid
+        self.pending = []   # dirs and files that still need a runid
+        self.full = 0       # ran out of watches?
+
+    def _add(self, d):
+        import ctypes
+        ent = self.dirs.get(d)
+        if ent:
+            return ent
+        wd = self.libc.inotify_add_watch(self.fd, d, _MASK)
+        if wd < 0:
+            e = ctypes.get_errno()
+            if e == errno.ENOSPC and not self.full:
+                from log import warn
+                warn('redo-watch: out of inotify watches; '
+                     'some files will be stat()ed instead.\n')
+                warn('redo-watch: (raise /proc/sys/fs/inotify/'
+                     'max_user_watches to fix.)\n')
+                self.full = 1
+            return None
+        ent = self.dirs[d] = [wd, None]
+        self.wds[wd] = d
+        self.pending.append(ent)
+        return ent
+
+    def watch(self, d):
+        """Watch d and all its parents; returns false if we can't."""
+        ok = 1
+        while 1:
+            if not self._add(d):
+                ok = 0
+            up = os.path.dirname(d)
+            if up == d:
+                break
+            d = up
+        return ok
+
+    def drop(self, d):
+        """Stop watching d and everything under it."""
+        pre = d.rstrip('/') + '/'
+        for k in self.dirs.keys():
+            if k == d or k.startswith(pre):
+                wd = self.dirs.pop(k)[0]
+                del self.wds[wd]
+                self.libc.inotify_rm_watch(self.fd, wd)
+
+    def read_events(self):
+        import struct
+        while 1:
+            try:
+                buf = os.read(self.fd, 65536)
+            except OSError, e:
+                if e.errno == errno.EAGAIN:
+                    return
+                raise
+            ofs = 0
+            while ofs < len(buf):
+                (wd, mask, cookie, namelen) = struct.unpack('iIII',
+                                                       buf[ofs:ofs+16])
+                name = buf[ofs+16:ofs+16+namelen].split('\0', 1)[0]
+                ofs += 16 + namelen
+                if mask & IN_Q_OVERFLOW:
+                    # we missed some events, so we don't know anything
+                    # anymore; start over.
+                    self.drop('/')
+                    continue
+                d = self.wds.get(wd)
+                if d == None:
+                    continue
+                if mask & (IN_DELETE_SELF | IN_MOVE_SELF | IN_IGNORED):
+                    self.drop(d)
+                    continue
+                if name:
+                    p = os.path.join(d, name)
+                    if p in self.dirs:
+                        self.drop(p)  # replaced by some other directory?
+                    self.changed[p] = None
+                    self.pending.append(p)
+
+    def settle(self):
+        """Give everything we did since last time the current runid."""
+        if not self.pending:
+            return
+        import state
+        runid = state.last_runid()
+        for p in self.pending:
+            if isinstance(p, list):
+                p[1] = runid
+            else:
+                self.changed[p] = runid
+        self.pending = []
+
+    def answer(self, names):
+        dirs = []
+        for n in names:
+            p = os.path.normpath(os.path.join(vars.BASE, n))
+            dirs.append((p, self.watch(os.path.dirname(p))))
+        self.settle()
+        out = []
+        for p,ok in dirs:
+            ent = ok and self.dirs.get(os.path.dirname(p))
+            if not ent:
+                out.append('0\n')
+            else:
+                out.append('%d\n' % (max(ent[1], self.changed.get(p, 0)) + 1))
+        return ''.join(out)
+
+
+def serve():
+    """Run the redo-watch daemon until we're killed."""
+    import select, signal, socket, state
+    from log import err
+    path = _path()
+    s = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    try:
+        s.connect(path)
+    except socket.error:
+        pass
+    else:
+        err('redo-watch: already running for %r\n' % vars.BASE)
+        return 1
+    w = Watcher()
+    for f in state.files():
+        if not f.name.startswith('//'):
+            p = os.path.normpath(os.path.join(vars.BASE, f.name))
+            w.watch(os.path.dirname(p))
+    w.settle()
+    try:
+        os.unlink(path)
+    except OSError:
+        pass
+    s.bind(path)
+    s.listen(128)
+    signal.signal(signal.SIGTERM, lambda sig, frame: sys.exit(0))
+    try:
+        while 1:
+            try:
+                r,x,x = select.select([s, w.fd], [], [])
+            except select.error, e:
+                if e.args[0] == errno.EINTR:
+                    continue
+                raise
+            if w.fd in r:
+                w.read_events()
+                w.settle()
+            if s in r:
+                (conn, addr) = s.accept()
+                try:
+                    req = []
+                    while 1:
+                        b = conn.recv(65536)
+                        if not b: break
+                        req.append(b)
+                    w.read_events()
+                    conn.sendall(w.answer(''.join(req).split('\n')[:-1]))
+                except socket.error:
+                    pass  # client went away; not our problem
+                conn.close()
+    finally:
+        try:
+            os.unlink(path)
+        except OSError:
+            pass